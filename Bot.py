@@ -1,19 +1,46 @@
 import asyncio
+import csv
+import hmac
+import io
+import os
+import sys
+import threading
 import logging
 import datetime
-import httpx
+import time
+import uuid
+import zlib
 import ssl as _ssl
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import NamedTuple
 
 from aiogram import Bot, Dispatcher, types, html
 from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
-from aiogram.types import Update
-from aiogram.filters import CommandStart
+from aiogram.types import Update, User
+from aiogram.types import InputMediaPhoto, InputMediaDocument
+from aiogram.types import CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.filters import CommandStart, Command, CommandObject
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest, TelegramNetworkError
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
 from os import getenv
 import asyncpg
 from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse
+
+import json
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:  # orjson не обязателен — работаем и на стандартном json
+    _json_loads = json.loads
 
 # -------------------------
 # Настройки
@@ -30,6 +57,9 @@ def _normalize_base_url(u: str) -> str:
 BASE_URL = getenv("BASE_URL") or getenv("RENDER_EXTERNAL_URL")
 BASE_URL = _normalize_base_url(BASE_URL)
 
+# Адрес Bot API можно подменить локальной заглушкой (тесты рассылки, бенчмарки)
+TELEGRAM_API_URL = getenv("TELEGRAM_API_URL")
+
 WEBHOOK_PATH = "/webhook"
 WEBHOOK_URL = f"{BASE_URL}{WEBHOOK_PATH}"
 
@@ -47,14 +77,230 @@ if not BASE_URL:
     logging.error("❌ Не найден ни BASE_URL, ни RENDER_EXTERNAL_URL. Укажи BASE_URL вручную, например https://<your-service>.onrender.com")
     raise SystemExit(1)
 
+# -------------------------
+# Метрики (формат Prometheus)
+# -------------------------
+# Свои простые счётчики/гистограммы вместо prometheus_client: запись — пара операций
+# со словарём, поэтому метрики можно держать включёнными в проде.
+METRICS = []
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    def __init__(self, name: str, doc: str, labels: tuple = ()):
+        self.name, self.doc, self.labels = name, doc, labels
+        self.values = {}
+        METRICS.append(self)
+
+    def inc(self, *label_values, amount: float = 1.0):
+        self.values[label_values] = self.values.get(label_values, 0.0) + amount
+
+    def value(self, *label_values) -> float:
+        return self.values.get(label_values, 0.0)
+
+    def expose(self) -> list:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"]
+        for label_values, value in self.values.items():
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+class Gauge:
+    # Значение считается в момент запроса /metrics
+    def __init__(self, name: str, doc: str, fn):
+        self.name, self.doc, self.fn = name, doc, fn
+        METRICS.append(self)
+
+    def expose(self) -> list:
+        try:
+            value = self.fn()
+        except Exception:
+            return []
+        return [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+class Histogram:
+    def __init__(self, name: str, doc: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name, self.doc, self.labels, self.buckets = name, doc, labels, buckets
+        self.values = {}  # label_values -> [счётчики по корзинам (+Inf последняя), сумма, количество]
+        METRICS.append(self)
+
+    def observe(self, value: float, *label_values):
+        entry = self.values.get(label_values)
+        if entry is None:
+            entry = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def expose(self) -> list:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labels, label_values, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+WEBHOOK_SECONDS = Histogram("bot_webhook_seconds", "Webhook request end-to-end latency")
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "aiogram handler latency", ("handler", "button"))
+DB_ACQUIRE_SECONDS = Histogram("bot_db_pool_acquire_seconds", "Wait for a connection from the asyncpg pool")
+DB_QUERY_SECONDS = Histogram("bot_db_query_seconds", "asyncpg query latency", ("method",))
+BOT_API_SECONDS = Histogram("bot_api_request_seconds", "Bot API call latency", ("method",))
+BOT_API_ERRORS = Counter("bot_api_errors_total", "Failed Bot API calls", ("method", "error"))
+UPDATES_TOTAL = Counter("bot_updates_total", "Webhook updates by outcome", ("outcome",))
+DB_ROUNDTRIPS = Histogram("bot_db_roundtrips_per_update", "DB round-trips spent on one update", buckets=(0, 1, 2, 3, 5, 10))
+
+# -------------------------
+# FSM-хранилище в Postgres
+# -------------------------
+# MemoryStorage живёт в одном процессе: при нескольких воркерах uvicorn следующее
+# сообщение админа попадает в процесс, который ничего не знает о его состоянии.
+FSM_STORAGE = getenv("FSM_STORAGE", "postgres")            # postgres | memory
+FSM_TTL = float(getenv("FSM_TTL", "3600"))                 # брошенные состояния забываем через час
+# Кэш авторитетный: чужие записи сбрасывают его через NOTIFY, после переподключения
+# LISTEN он чистится целиком. TTL — только страховка, иначе утреннее нажатие
+# каждый раз ходило бы в FsmStates за пустым состоянием.
+FSM_CACHE_TTL = float(getenv("FSM_CACHE_TTL", "86400"))
+FSM_CACHE_MAX = 10000
+FSM_NOTIFY_CHANNEL = "fsm_changed"
+
+class PostgresStorage(BaseStorage):
+    def __init__(self):
+        # key -> [state, data, expires_at]; сбрасывается по NOTIFY от других процессов
+        self._cache = OrderedDict()
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return (f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id}:"
+                f"{key.business_connection_id}:{key.destiny}")
+
+    def _cached(self, key: str):
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        if entry[2] < time.monotonic():
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)   # LRU: при переполнении вытесняем давно не нужные
+        return entry
+
+    def _remember(self, key: str, state, data: dict, ttl: float = FSM_CACHE_TTL):
+        self._cache.pop(key, None)
+        self._cache[key] = [state, data, time.monotonic() + ttl]
+        while len(self._cache) > FSM_CACHE_MAX:
+            self._cache.popitem(last=False)
+
+    def forget(self, key: str = None):
+        if key is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(key, None)
+
+    async def _load(self, key: str):
+        entry = self._cached(key)
+        if entry is not None:
+            return entry
+        async with db_acquire() as conn:
+            row = await conn.fetchrow(
+                "SELECT state, data, EXTRACT(EPOCH FROM now() - updated_at) AS age FROM FsmStates "
+                "WHERE key=$1 AND updated_at > now() - make_interval(secs => $2)",
+                key, FSM_TTL
+            )
+        if row is None:
+            self._remember(key, None, {})
+        else:
+            # Брошенное состояние должно пропасть и из кэша, когда истечёт FSM_TTL
+            self._remember(key, row["state"], json.loads(row["data"]),
+                           min(FSM_CACHE_TTL, FSM_TTL - float(row["age"])))
+        return self._cache[key]
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k = self._key(key)
+        state = state.state if isinstance(state, State) else state
+        # Одним запросом: запись + уведомление остальных процессов
+        async with db_acquire() as conn:
+            await conn.execute(
+                """
+                WITH up AS (
+                    INSERT INTO FsmStates (key, state) VALUES ($1, $2)
+                    ON CONFLICT (key) DO UPDATE SET state = EXCLUDED.state, updated_at = now()
+                )
+                SELECT pg_notify($3, $4)
+                """,
+                k, state, FSM_NOTIFY_CHANNEL, f"{INSTANCE_ID}|{k}"
+            )
+        entry = self._cached(k)
+        if entry is not None:
+            entry[0] = state
+            entry[2] = time.monotonic() + min(FSM_CACHE_TTL, FSM_TTL)
+
+    async def get_state(self, key: StorageKey):
+        return (await self._load(self._key(key)))[0]
+
+    async def set_data(self, key: StorageKey, data: dict) -> None:
+        k = self._key(key)
+        async with db_acquire() as conn:
+            await conn.execute(
+                """
+                WITH up AS (
+                    INSERT INTO FsmStates (key, data) VALUES ($1, $2::jsonb)
+                    ON CONFLICT (key) DO UPDATE SET data = EXCLUDED.data, updated_at = now()
+                )
+                SELECT pg_notify($3, $4)
+                """,
+                k, json.dumps(data, ensure_ascii=False), FSM_NOTIFY_CHANNEL, f"{INSTANCE_ID}|{k}"
+            )
+        entry = self._cached(k)
+        if entry is not None:
+            entry[1] = data.copy()
+            entry[2] = time.monotonic() + min(FSM_CACHE_TTL, FSM_TTL)
+
+    async def get_data(self, key: StorageKey) -> dict:
+        return (await self._load(self._key(key)))[1].copy()
+
+    async def close(self) -> None:
+        self._cache.clear()  # пул закрывается в on_shutdown
+
+def _on_fsm_notify(conn, pid, channel, payload):
+    instance_id, _, key = payload.partition("|")
+    if instance_id != INSTANCE_ID:
+        storage.forget(key)
+
+async def fsm_cleanup_loop():
+    while True:
+        await asyncio.sleep(600)
+        try:
+            async with db_acquire() as conn:
+                deleted = await conn.execute(
+                    "DELETE FROM FsmStates WHERE updated_at < now() - make_interval(secs => $1)", FSM_TTL
+                )
+            logger.info(f"FSM cleanup: {deleted}")
+        except Exception as e:
+            logger.error(f"FSM cleanup failed: {e!r}")
+
 # -------------------------
 # Bot / Dispatcher / Storage
 # -------------------------
 bot = None                # создадим в startup
-storage = MemoryStorage()
+storage = PostgresStorage() if FSM_STORAGE == "postgres" else MemoryStorage()
 dp = Dispatcher(storage=storage)
 
 pool = None  # будет инициализирован в init_db
+_db_ssl = None  # SSL-контекст, с которым удалось подключиться (нужен для LISTEN-соединения)
+
+# Идентификатор процесса — чтобы не реагировать на собственные NOTIFY
+INSTANCE_ID = uuid.uuid4().hex
 
 # -------------------------
 # FSM
@@ -62,6 +308,10 @@ pool = None  # будет инициализирован в init_db
 class DzStates(StatesGroup):
     choosing_subject = State()
     writing_homework = State()
+    bulk_import = State()
+
+class ClassStates(StatesGroup):
+    choosing_class = State()
 
 ADMINS = [1920672301, 5251769398]
 
@@ -78,6 +328,11 @@ subjects = [
     "География", "Обществознание", "ВиС", "БПЛА"
 ]
 
+# Основной класс: сюда попадают пользователи без выбранного класса,
+# а DZ_VAR1/DZ_VAR2 — его начальное расписание (засевается в Lessons при первом запуске)
+DEFAULT_CLASS = getenv("DEFAULT_CLASS", "Основной")
+NO_LESSON = "-"
+
 DZ_VAR1 = [
     ["Разговор о важном", "Физкультура", "Химия", "Информатика", "Информатика", "Физика", "Физика"],
     ["Литература", "ОБЗР", "Алгебра", "Алгебра", "Английский язык", "Английский язык", "Литература"],
@@ -94,32 +349,130 @@ DZ_VAR2 = [
     ["Литература", "Алгебра", "Алгебра", "География", "Обществознание", "Спецкурс по физике", "Обществознание"]
 ]
 
+RUS_DAYS = ["Понедельник","Вторник","Среда","Четверг","Пятница","Суббота","Воскресенье"]
+RUS_MONTHS = ["Января","Февраля","Марта","Апреля","Мая","Июня",
+              "Июля","Августа","Сентября","Октября","Ноября","Декабря"]
+
+def format_hw_date(d):
+    # date -> "Понедельник, 5 Сентября"
+    if d is None:
+        return None
+    return f"{RUS_DAYS[d.weekday()]}, {d.day} {RUS_MONTHS[d.month-1]}"
+
 # -------------------------
 # Меню
 # -------------------------
-def get_main_menu(user_id: int) -> ReplyKeyboardMarkup:
+def _build_main_menu(is_admin: bool) -> ReplyKeyboardMarkup:
     buttons = [
         [KeyboardButton(text="📅 Дз на сегодня")],
         [KeyboardButton(text="📅 Дз на завтра")],
         [KeyboardButton(text="📖 Полное расписание")],
         [KeyboardButton(text="🔄 Сменить вариант группы")]
     ]
-    if user_id in ADMINS:
+    if is_admin:
         buttons.append([KeyboardButton(text="Добавить ДЗ")])
     return ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True)
 
+# Клавиатуры не меняются — собираем один раз и переиспользуем
+MAIN_MENU = _build_main_menu(is_admin=False)
+ADMIN_MENU = _build_main_menu(is_admin=True)
+
+def get_main_menu(user_id: int) -> ReplyKeyboardMarkup:
+    return ADMIN_MENU if user_id in ADMINS else MAIN_MENU
+
 # -------------------------
 # Инициализация БД
 # -------------------------
-async def init_db():
-    global pool
+def _db_dsn() -> str:
     # Нормализуем DSN для asyncpg
-    dsn = DATABASE_URL.replace("postgres://", "postgresql://")
+    return DATABASE_URL.replace("postgres://", "postgresql://")
+
+# Локальный Postgres (бенчмарки, разработка) обычно без SSL: DB_SSL=0
+DB_SSL = getenv("DB_SSL", "1") != "0"
+
+# FAST_START=1 — быстрый холодный старт для засыпающего хостинга: БД и бот
+# поднимаются параллельно, DDL пропускается при совпадении версии схемы,
+# вебхук переустанавливается только если Telegram видит другие настройки.
+FAST_START = getenv("FAST_START", "0") == "1"
+# Пул asyncpg по умолчанию открывает 10 соединений сразу — при быстром старте хватит одного
+DB_POOL_MIN = int(getenv("DB_POOL_MIN", "1" if FAST_START else "10"))
+
+# Менять при любом изменении DDL в create_schema
+SCHEMA_VERSION = 4
+
+def schema_fingerprint() -> str:
+    # Список предметов тоже засевается в create_schema — учитываем его в версии
+    return f"{SCHEMA_VERSION}:{zlib.crc32('|'.join(subjects).encode())}"
+
+# Счётчик обращений к БД для текущего апдейта (см. feed_update)
+db_roundtrips = ContextVar("db_roundtrips", default=None)
+
+class TrackedConnection(asyncpg.Connection):
+    # Каждый вызов — один запрос к серверу (BEGIN/COMMIT транзакций тоже идут через execute).
+    # Сброс сессии, который asyncpg шлёт при возврате соединения в пул, к обращениям
+    # обработчика не относим: он идёт на каждый acquire и виден как method="reset".
+    _resetting = False
+
+    async def reset(self, *, timeout=None):
+        self._resetting = True
+        started = time.perf_counter()
+        try:
+            return await super().reset(timeout=timeout)
+        finally:
+            self._resetting = False
+            DB_QUERY_SECONDS.observe(time.perf_counter() - started, "reset")
+
+    async def _tracked(self, method: str, coro):
+        if self._resetting:
+            return await coro
+        counter = db_roundtrips.get()
+        if counter is not None:
+            counter[0] += 1
+        started = time.perf_counter()
+        try:
+            return await coro
+        finally:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - started, method)
+
+    async def execute(self, query, *args, **kwargs):
+        return await self._tracked("execute", super().execute(query, *args, **kwargs))
+
+    async def executemany(self, command, args, **kwargs):
+        return await self._tracked("executemany", super().executemany(command, args, **kwargs))
+
+    async def fetch(self, query, *args, **kwargs):
+        return await self._tracked("fetch", super().fetch(query, *args, **kwargs))
+
+    async def fetchrow(self, query, *args, **kwargs):
+        return await self._tracked("fetchrow", super().fetchrow(query, *args, **kwargs))
+
+    async def fetchval(self, query, *args, **kwargs):
+        return await self._tracked("fetchval", super().fetchval(query, *args, **kwargs))
+
+@asynccontextmanager
+async def db_acquire():
+    # pool.acquire() с замером ожидания свободного соединения
+    started = time.perf_counter()
+    async with pool.acquire() as conn:
+        DB_ACQUIRE_SECONDS.observe(time.perf_counter() - started)
+        yield conn
+
+async def init_db():
+    global pool, _db_ssl
+    dsn = _db_dsn()
+
+    if not DB_SSL:
+        pool = await asyncpg.create_pool(dsn, ssl=False, min_size=DB_POOL_MIN, connection_class=TrackedConnection)
+        _db_ssl = False
+        await create_schema()
+        return
 
     # 1) Пытаемся подключиться с проверкой сертификата (рекомендуемый вариант)
     verified_ctx = _ssl.create_default_context()
     try:
-        pool = await asyncpg.create_pool(dsn, ssl=verified_ctx)
+        pool = await asyncpg.create_pool(dsn, ssl=verified_ctx, min_size=DB_POOL_MIN,
+                                         connection_class=TrackedConnection)
+        _db_ssl = verified_ctx
     except _ssl.SSLCertVerificationError as e:
         logger.warning("SSL verification failed (self-signed cert). Falling back to UNVERIFIED SSL context. "
                        "Это небезопасно в проде — по возможности настроить доверенный сертификат или sslmode=require.")
@@ -127,9 +480,23 @@ async def init_db():
         unverified_ctx = _ssl.create_default_context()
         unverified_ctx.check_hostname = False
         unverified_ctx.verify_mode = _ssl.CERT_NONE
-        pool = await asyncpg.create_pool(dsn, ssl=unverified_ctx)
+        pool = await asyncpg.create_pool(dsn, ssl=unverified_ctx, min_size=DB_POOL_MIN,
+                                         connection_class=TrackedConnection)
+        _db_ssl = unverified_ctx
+    await create_schema()
 
-    async with pool.acquire() as conn:
+async def schema_is_current(conn) -> bool:
+    try:
+        version = await conn.fetchval("SELECT version FROM SchemaVersion WHERE id=1")
+    except asyncpg.UndefinedTableError:
+        return False
+    return version == schema_fingerprint()
+
+async def create_schema():
+    async with db_acquire() as conn:
+        if FAST_START and await schema_is_current(conn):
+            logger.info(f"Schema {schema_fingerprint()} is current, DDL skipped")
+            return
         await conn.execute("""
         CREATE TABLE IF NOT EXISTS UserInfo (
             id SERIAL PRIMARY KEY,
@@ -138,18 +505,179 @@ async def init_db():
             user_option INT
         )
         """)
-        cols = ', '.join([f'"{subj}" TEXT, "{subj}_date" TEXT' for subj in subjects])
-        await conn.execute(f"""
-        CREATE TABLE IF NOT EXISTS Dz_Table (
+        await conn.execute("""
+        CREATE TABLE IF NOT EXISTS Subjects (
             id SERIAL PRIMARY KEY,
-            {cols}
+            name TEXT UNIQUE NOT NULL
+        )
+        """)
+        await conn.execute("""
+        CREATE TABLE IF NOT EXISTS Classes (
+            id SERIAL PRIMARY KEY,
+            name TEXT UNIQUE NOT NULL
+        )
+        """)
+        # Уроки: week 0 — каждую неделю, 1 — только нечётные, 2 — только чётные;
+        # subject_id NULL — окно в расписании
+        await conn.execute("""
+        CREATE TABLE IF NOT EXISTS Lessons (
+            class_id INT NOT NULL REFERENCES Classes(id),
+            variant SMALLINT NOT NULL,
+            week SMALLINT NOT NULL DEFAULT 0,
+            weekday SMALLINT NOT NULL,
+            slot SMALLINT NOT NULL,
+            subject_id INT REFERENCES Subjects(id),
+            PRIMARY KEY (class_id, variant, week, weekday, slot)
+        )
+        """)
+        await conn.execute("ALTER TABLE UserInfo ADD COLUMN IF NOT EXISTS class_id INT REFERENCES Classes(id)")
+        # История ДЗ: только добавляем строки, актуальное — последняя по created_at
+        await conn.execute("""
+        CREATE TABLE IF NOT EXISTS Homework (
+            id BIGSERIAL PRIMARY KEY,
+            subject_id INT NOT NULL REFERENCES Subjects(id),
+            body TEXT NOT NULL,
+            hw_date DATE,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        """)
+        await conn.execute("ALTER TABLE Homework ADD COLUMN IF NOT EXISTS class_id INT REFERENCES Classes(id)")
+        await conn.execute("DROP INDEX IF EXISTS homework_subject_created_idx")
+        await conn.execute("""
+        CREATE INDEX IF NOT EXISTS homework_class_subject_created_idx
+        ON Homework (class_id, subject_id, created_at DESC)
+        """)
+        # Вложения храним как file_id Telegram: при отправке байты не гоняем.
+        # file_unique_id одинаков для одного и того же файла — по нему убираем повторы
+        await conn.execute("""
+        CREATE TABLE IF NOT EXISTS HomeworkAttachments (
+            homework_id BIGINT NOT NULL REFERENCES Homework(id) ON DELETE CASCADE,
+            position SMALLINT NOT NULL,
+            kind TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            file_unique_id TEXT NOT NULL,
+            PRIMARY KEY (homework_id, position),
+            UNIQUE (homework_id, file_unique_id)
+        )
+        """)
+        # Вложения, присланные админом до текста ДЗ. Каждая часть альбома — отдельная
+        # строка: части могут обрабатываться разными воркерами одновременно
+        await conn.execute("""
+        CREATE TABLE IF NOT EXISTS PendingAttachments (
+            id BIGSERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            kind TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            file_unique_id TEXT NOT NULL,
+            UNIQUE (user_id, file_unique_id)
+        )
+        """)
+        await conn.execute("""
+        CREATE TABLE IF NOT EXISTS Broadcasts (
+            id BIGSERIAL PRIMARY KEY,
+            text TEXT NOT NULL,
+            variants INT[] NOT NULL,
+            last_user_id BIGINT NOT NULL DEFAULT 0,
+            sent INT NOT NULL DEFAULT 0,
+            failed INT NOT NULL DEFAULT 0,
+            done BOOLEAN NOT NULL DEFAULT FALSE,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        """)
+        await conn.execute("ALTER TABLE Broadcasts ADD COLUMN IF NOT EXISTS class_id INT")
+        await conn.execute("""
+        CREATE TABLE IF NOT EXISTS FsmStates (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data JSONB NOT NULL DEFAULT '{}',
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        """)
+        # Новый предмет — просто новая строка, без DDL
+        await conn.executemany(
+            "INSERT INTO Subjects (name) VALUES ($1) ON CONFLICT (name) DO NOTHING",
+            [(subj,) for subj in subjects]
+        )
+        default_class_id = await seed_default_class(conn)
+        await migrate_dz_table(conn)
+        # ДЗ, записанное до появления классов, — это ДЗ основного класса
+        await conn.execute("UPDATE Homework SET class_id = $1 WHERE class_id IS NULL", default_class_id)
+        await conn.execute("""
+        CREATE TABLE IF NOT EXISTS SchemaVersion (
+            id INT PRIMARY KEY DEFAULT 1,
+            version TEXT NOT NULL
         )
         """)
-        exists = await conn.fetchval("SELECT COUNT(*) FROM Dz_Table")
-        if exists == 0:
-            cols_names = ', '.join([f'"{subj}"' for subj in subjects])
-            values = ', '.join(["'Ничего'" for _ in subjects])
-            await conn.execute(f'INSERT INTO Dz_Table ({cols_names}) VALUES ({values})')
+        await conn.execute(
+            "INSERT INTO SchemaVersion (id, version) VALUES (1, $1) "
+            "ON CONFLICT (id) DO UPDATE SET version = EXCLUDED.version",
+            schema_fingerprint()
+        )
+
+async def seed_default_class(conn) -> int:
+    # Основной класс получает расписание из DZ_VAR1/DZ_VAR2, если своего ещё нет
+    class_id = await conn.fetchval(
+        "INSERT INTO Classes (name) VALUES ($1) "
+        "ON CONFLICT (name) DO UPDATE SET name = EXCLUDED.name RETURNING id",
+        DEFAULT_CLASS
+    )
+    if await conn.fetchval("SELECT EXISTS (SELECT 1 FROM Lessons WHERE class_id=$1)", class_id):
+        return class_id
+    records = []
+    for variant, days in ((1, DZ_VAR1), (2, DZ_VAR2)):
+        for weekday, day in enumerate(days):
+            for slot, subj in enumerate(day, start=1):
+                records.append((class_id, variant, weekday, slot, None if subj == NO_LESSON else subj))
+    await conn.executemany(
+        "INSERT INTO Lessons (class_id, variant, week, weekday, slot, subject_id) "
+        "VALUES ($1, $2, 0, $3, $4, (SELECT id FROM Subjects WHERE name = $5))",
+        records
+    )
+    logger.info(f"Timetable for class {DEFAULT_CLASS!r} seeded from DZ_VAR1/DZ_VAR2")
+    return class_id
+
+def parse_legacy_date(date_str, today: datetime.date):
+    # "Понедельник, 5 Сентября" -> date; год в старом формате не хранился
+    try:
+        _, day_month = date_str.split(", ", 1)
+        day, month_name = day_month.split(" ", 1)
+        parsed = datetime.date(today.year, RUS_MONTHS.index(month_name) + 1, int(day))
+    except (AttributeError, ValueError):
+        return None
+    if parsed > today:
+        parsed = parsed.replace(year=today.year - 1)
+    return parsed
+
+async def migrate_dz_table(conn):
+    # Разовый перенос из старой широкой таблицы Dz_Table в Homework.
+    # Запускается, только пока Homework пустая; саму Dz_Table не трогаем.
+    if await conn.fetchval("SELECT to_regclass('dz_table') IS NULL"):
+        return
+    async with conn.transaction():
+        # Несколько воркеров стартуют одновременно — переносим только один раз
+        await conn.execute("SELECT pg_advisory_xact_lock(hashtext('migrate_dz_table'))")
+        if await conn.fetchval("SELECT EXISTS (SELECT 1 FROM Homework)"):
+            return
+        row = await conn.fetchrow("SELECT * FROM Dz_Table WHERE id=1")
+        if row is None:
+            return
+        today = datetime.date.today()
+        records = []
+        for subj in subjects:
+            hw = row.get(subj)
+            date_str = row.get(f"{subj}_date")
+            if hw is None or (hw == "Ничего" and not date_str):
+                continue  # ДЗ по предмету так и не задавали
+            records.append((subj, hw, parse_legacy_date(date_str, today)))
+        await conn.executemany(
+            """
+            INSERT INTO Homework (subject_id, body, hw_date, created_at)
+            SELECT id, $2, $3, COALESCE($3::date::timestamptz, now())
+            FROM Subjects WHERE name = $1
+            """,
+            records
+        )
+    logger.info(f"Dz_Table migrated to Homework: {len(records)} rows")
 
 async def init_db_with_retry(retries: int = 5, delay: int = 3):
     last_err = None
@@ -166,6 +694,550 @@ async def init_db_with_retry(retries: int = 5, delay: int = 3):
     # если так и не поднялись — пробрасываем, чтобы упасть с понятной причиной
     raise last_err
 
+# -------------------------
+# Кэш домашки (снапшот в памяти)
+# -------------------------
+# Актуальное ДЗ меняется только в add_dz_save, поэтому читаем его из памяти.
+# Другие воркеры/реплики узнают об изменении через LISTEN/NOTIFY.
+HW_NOTIFY_CHANNEL = "dz_updated"
+HW_CACHE_TTL = int(getenv("HW_CACHE_TTL", "300"))       # страховка на случай пропущенного NOTIFY
+HW_RETRY_DELAY = int(getenv("HW_RETRY_DELAY", "5"))     # пауза между попытками, если БД недоступна
+
+# Последнее ДЗ по каждому предмету каждого класса — по одному проходу индекса на пару,
+# вложения к нему — тем же запросом
+CURRENT_HOMEWORK_SQL = """
+SELECT cs.class_id, s.name, h.body, h.hw_date, a.kinds, a.file_ids
+FROM (SELECT DISTINCT class_id, subject_id FROM Lessons WHERE subject_id IS NOT NULL) cs
+JOIN Subjects s ON s.id = cs.subject_id
+LEFT JOIN LATERAL (
+    SELECT id, body, hw_date FROM Homework
+    WHERE class_id = cs.class_id AND subject_id = cs.subject_id
+    ORDER BY created_at DESC
+    LIMIT 1
+) h ON TRUE
+LEFT JOIN LATERAL (
+    SELECT array_agg(kind ORDER BY position) AS kinds, array_agg(file_id ORDER BY position) AS file_ids
+    FROM HomeworkAttachments WHERE homework_id = h.id
+) a ON TRUE
+"""
+
+# class_id -> {предмет -> ДЗ, "<предмет>_date" -> дата строкой,
+#              "<предмет>_files" -> ((вид, file_id), ...)}
+hw_snapshot = None
+hw_version = 0       # растёт при каждой успешной загрузке снапшота
+_hw_expires_at = 0.0
+_hw_dirty = False
+_hw_refresh_task = None
+_listener_task = None
+
+async def load_homework_snapshot():
+    global hw_snapshot, hw_version, _hw_expires_at
+    if pool is None:
+        raise RuntimeError("Пул базы данных ещё не инициализирован")
+    async with db_acquire() as conn:
+        rows = await conn.fetch(CURRENT_HOMEWORK_SQL)
+    snapshot = {}
+    for row in rows:
+        homework = snapshot.setdefault(row["class_id"], {})
+        homework[row["name"]] = row["body"] if row["body"] is not None else "Ничего"
+        homework[f"{row['name']}_date"] = format_hw_date(row["hw_date"])
+        if row["file_ids"]:
+            homework[f"{row['name']}_files"] = tuple(zip(row["kinds"], row["file_ids"]))
+    hw_snapshot = snapshot
+    hw_version += 1
+    _hw_expires_at = time.monotonic() + HW_CACHE_TTL
+    logger.info(f"Homework snapshot loaded: version={hw_version}")
+
+async def _refresh_homework_loop():
+    global _hw_dirty, _hw_expires_at
+    # Пока во время загрузки приходят новые уведомления — перечитываем ещё раз
+    while _hw_dirty:
+        _hw_dirty = False
+        try:
+            await load_homework_snapshot()
+        except Exception as e:
+            # stale-while-revalidate: отдаём старый снапшот, повторим позже
+            _hw_expires_at = time.monotonic() + HW_RETRY_DELAY
+            logger.error(f"Homework snapshot refresh failed, serving stale version={hw_version}: {e!r}")
+            return
+
+def schedule_homework_refresh() -> asyncio.Task:
+    global _hw_dirty, _hw_refresh_task
+    _hw_dirty = True
+    if _hw_refresh_task is None or _hw_refresh_task.done():
+        _hw_refresh_task = asyncio.create_task(_refresh_homework_loop())
+    return _hw_refresh_task
+
+async def get_homework_snapshot() -> dict:
+    if hw_snapshot is None:
+        # Холодный кэш — тут без вариантов, нужно сходить в БД
+        await load_homework_snapshot()
+    elif time.monotonic() >= _hw_expires_at:
+        schedule_homework_refresh()
+    return hw_snapshot
+
+async def notify_homework_changed(conn):
+    # Вызывать внутри транзакции с UPDATE — NOTIFY уйдёт только после COMMIT
+    await conn.execute("SELECT pg_notify($1, $2)", HW_NOTIFY_CHANNEL, INSTANCE_ID)
+
+def _on_homework_notify(conn, pid, channel, payload):
+    if payload == INSTANCE_ID:
+        return  # своё же изменение, снапшот уже обновлён в add_dz_save
+    logger.info(f"Homework changed by another instance ({payload}), refreshing snapshot")
+    schedule_homework_refresh()
+
+# Каналы NOTIFY, которые слушает процесс: канал -> обработчик(payload).
+# После переподключения вызываются on_reconnect — уведомления за это время потеряны.
+notify_handlers = {HW_NOTIFY_CHANNEL: _on_homework_notify}
+notify_reconnect_hooks = [schedule_homework_refresh]
+if isinstance(storage, PostgresStorage):
+    notify_handlers[FSM_NOTIFY_CHANNEL] = _on_fsm_notify
+    notify_reconnect_hooks.append(storage.forget)
+
+async def notify_listener():
+    # Отдельное соединение вне пула: LISTEN живёт, пока живо соединение
+    reconnect = False
+    while True:
+        conn = None
+        try:
+            conn = await asyncpg.connect(_db_dsn(), ssl=_db_ssl)
+            for channel, handler in notify_handlers.items():
+                await conn.add_listener(channel, handler)
+            logger.info(f"Listening for notifications: {', '.join(notify_handlers)}")
+            if reconnect:
+                # Пока соединения не было — могли пропустить изменения
+                for hook in notify_reconnect_hooks:
+                    hook()
+            reconnect = True
+            while not conn.is_closed():
+                await asyncio.sleep(30)
+            logger.warning("Notify listener connection closed, reconnecting")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Notify listener error: {e!r}. Retry in {HW_RETRY_DELAY}s")
+        finally:
+            if conn is not None and not conn.is_closed():
+                try:
+                    await conn.close()
+                except Exception:
+                    pass
+        await asyncio.sleep(HW_RETRY_DELAY)
+
+# -------------------------
+# Профиль пользователя за один запрос
+# -------------------------
+# Нажатие кнопки обновляет имя и читает (вариант, класс) одним выражением:
+# один round-trip, без отдельного SELECT. Имя пишется, только если изменилось;
+# если писать нечего, CTE пуст и строку отдаёт второй SELECT. asyncpg сам
+# держит подготовленные выражения в кэше каждого соединения.
+TOUCH_USER_SQL = """
+WITH up AS (
+    INSERT INTO UserInfo (user_id, user_name)
+    VALUES ($1, $2)
+    ON CONFLICT (user_id) DO UPDATE
+    SET user_name = EXCLUDED.user_name
+    WHERE UserInfo.user_name IS DISTINCT FROM EXCLUDED.user_name
+    RETURNING user_option, class_id
+)
+SELECT user_option, class_id FROM up
+UNION ALL
+SELECT user_option, class_id FROM UserInfo
+WHERE user_id = $1 AND NOT EXISTS (SELECT 1 FROM up)
+"""
+
+# -------------------------
+# Расписание классов
+# -------------------------
+# Расписания лежат в Classes/Lessons и при загрузке компилируются в словарь
+# (класс, вариант, чётность недели, день) -> уроки, так что поиск — O(1) при любом
+# числе классов. После правки Lessons хватает /reload_timetable (или NOTIFY
+# timetable_changed) — новое расписание подменяется без перезапуска.
+TIMETABLE_NOTIFY_CHANNEL = "timetable_changed"
+
+TIMETABLE_SQL = """
+SELECT l.class_id, l.variant, l.week, l.weekday, l.slot, s.name AS subject
+FROM Lessons l
+LEFT JOIN Subjects s ON s.id = l.subject_id
+"""
+
+class Timetable(NamedTuple):
+    version: int
+    slots: dict            # (class_id, вариант, чётность 1/2, день) -> кортеж предметов, "-" — окно
+    class_names: dict      # class_id -> название
+    class_ids: dict        # название -> class_id
+    class_subjects: dict   # class_id -> frozenset предметов
+    class_variants: dict   # class_id -> кортеж вариантов
+    default_class_id: int
+
+timetable = Timetable(version=0, slots={}, class_names={}, class_ids={},
+                      class_subjects={}, class_variants={}, default_class_id=None)
+_timetable_reload_task = None
+
+def week_parity(d: datetime.date) -> int:
+    # 1 — нечётная неделя, 2 — чётная (по ISO-нумерации)
+    return 1 if d.isocalendar()[1] % 2 else 2
+
+def next_school_day(d: datetime.date) -> datetime.date:
+    while d.weekday() > 4:
+        d += datetime.timedelta(days=1)
+    return d
+
+def compile_timetable(classes, lessons, version: int) -> Timetable:
+    grid = {}  # (класс, вариант, чётность, день) -> {урок: (week, предмет)}
+    class_subjects = {}
+    class_variants = {}
+    for lesson in lessons:
+        subject = lesson["subject"] or NO_LESSON
+        parities = (1, 2) if lesson["week"] == 0 else (lesson["week"],)
+        for parity in parities:
+            day = grid.setdefault((lesson["class_id"], lesson["variant"], parity, lesson["weekday"]), {})
+            current = day.get(lesson["slot"])
+            # Урок конкретной недели важнее урока «каждую неделю»
+            if current is None or current[0] == 0:
+                day[lesson["slot"]] = (lesson["week"], subject)
+        if lesson["subject"]:
+            class_subjects.setdefault(lesson["class_id"], set()).add(lesson["subject"])
+        class_variants.setdefault(lesson["class_id"], set()).add(lesson["variant"])
+
+    slots = {
+        key: tuple(day.get(slot, (0, NO_LESSON))[1] for slot in range(1, max(day) + 1))
+        for key, day in grid.items()
+    }
+    class_names = {row["id"]: row["name"] for row in classes}
+    class_ids = {name: class_id for class_id, name in class_names.items()}
+    return Timetable(
+        version=version,
+        slots=slots,
+        class_names=class_names,
+        class_ids=class_ids,
+        class_subjects={class_id: frozenset(names) for class_id, names in class_subjects.items()},
+        class_variants={class_id: tuple(sorted(v)) for class_id, v in class_variants.items()},
+        default_class_id=class_ids.get(DEFAULT_CLASS),
+    )
+
+async def load_timetable():
+    global timetable
+    if pool is None:
+        raise RuntimeError("Пул базы данных ещё не инициализирован")
+    async with db_acquire() as conn:
+        classes = await conn.fetch("SELECT id, name FROM Classes")
+        lessons = await conn.fetch(TIMETABLE_SQL)
+    timetable = compile_timetable(classes, lessons, timetable.version + 1)
+    logger.info(f"Timetable compiled: version={timetable.version} classes={len(timetable.class_names)} "
+                f"days={len(timetable.slots)}")
+
+async def _reload_timetable():
+    try:
+        await load_timetable()
+    except Exception as e:
+        logger.error(f"Timetable reload failed, keeping version={timetable.version}: {e!r}")
+
+def schedule_timetable_reload() -> asyncio.Task:
+    global _timetable_reload_task
+    if _timetable_reload_task is None or _timetable_reload_task.done():
+        _timetable_reload_task = asyncio.create_task(_reload_timetable())
+    return _timetable_reload_task
+
+def _on_timetable_notify(conn, pid, channel, payload):
+    if payload != INSTANCE_ID:
+        logger.info(f"Timetable changed by another instance ({payload}), reloading")
+        schedule_timetable_reload()
+
+notify_handlers[TIMETABLE_NOTIFY_CHANNEL] = _on_timetable_notify
+notify_reconnect_hooks.append(schedule_timetable_reload)
+
+def resolve_class(class_id) -> int:
+    # Пользователи без класса (и с удалённым классом) — в основном классе
+    return class_id if class_id in timetable.class_names else timetable.default_class_id
+
+def class_subject_list(class_id: int) -> list:
+    names = timetable.class_subjects.get(class_id, frozenset())
+    # Порядок как в общем списке subjects, предметы не из списка — в конце
+    return [subj for subj in subjects if subj in names] + sorted(names.difference(subjects))
+
+# -------------------------
+# Готовые ответы
+# -------------------------
+# Ответ для (класс, вариант, чётность недели, день) собирается при первом запросе
+# и живёт до смены версии ДЗ или расписания — дальше только поиск в словаре.
+DAYS = RUS_DAYS[:5]
+NO_OPTION_TEXT = "❌ Сначала выбери вариант через кнопку '🔄 Сменить вариант группы'"
+
+MEDIA_GROUP_MAX = 10   # лимит Telegram на альбом
+
+class Rendered(NamedTuple):
+    version: tuple   # (версия ДЗ, версия расписания)
+    days: dict       # (класс, вариант, чётность, день) -> HTML
+    full: dict       # (класс, вариант, чётность) -> HTML
+    media: dict      # (класс, вариант, чётность, день) -> альбомы вложений
+
+_rendered = Rendered(version=(-1, -1), days={}, full={}, media={})
+
+def _render_day(row: dict, lessons: tuple, variant: int, day_index: int) -> str:
+    parts = [f"<b><u>{DAYS[day_index]} — Вариант {variant}</u></b>\n\n"]
+    if not lessons:
+        parts.append("<b>Уроков нет</b>\n")
+    for i, subj in enumerate(lessons, start=1):
+        if subj == NO_LESSON:
+            parts.append(f"<b>{i}. ❌ Нет урока</b>\n")
+            continue
+        date = row.get(f"{subj}_date")
+        parts.append(f"<b>{i}. {html.quote(subj)} — {html.quote(row.get(subj, 'Ничего'))}</b>")
+        if date:
+            parts.append(f" [{date}]")
+        if f"{subj}_files" in row:
+            parts.append(" 📎")
+        parts.append("\n")
+    return "".join(parts)
+
+async def get_rendered() -> Rendered:
+    global _rendered
+    await get_homework_snapshot()
+    version = (hw_version, timetable.version)
+    if _rendered.version != version:
+        _rendered = Rendered(version=version, days={}, full={}, media={})
+    return _rendered
+
+def rendered_day(rendered: Rendered, class_id: int, variant: int, parity: int, day_index: int) -> str:
+    key = (class_id, variant, parity, day_index)
+    text = rendered.days.get(key)
+    if text is None:
+        text = _render_day(hw_snapshot.get(class_id, {}), timetable.slots.get(key, ()), variant, day_index)
+        rendered.days[key] = text
+    return text
+
+def _build_media(row: dict, lessons: tuple) -> tuple:
+    # Фото и документы Telegram в один альбом не смешивает — собираем их раздельно
+    photos, documents = [], []
+    for subj in dict.fromkeys(lessons):
+        for kind, file_id in row.get(f"{subj}_files", ()):
+            if kind == "photo":
+                photos.append(InputMediaPhoto(media=file_id, caption=subj))
+            else:
+                documents.append(InputMediaDocument(media=file_id, caption=subj))
+    return tuple(
+        items[i:i + MEDIA_GROUP_MAX]
+        for items in (photos, documents)
+        for i in range(0, len(items), MEDIA_GROUP_MAX)
+    )
+
+def rendered_media(rendered: Rendered, class_id: int, variant: int, parity: int, day_index: int) -> tuple:
+    key = (class_id, variant, parity, day_index)
+    media = rendered.media.get(key)
+    if media is None:
+        media = _build_media(hw_snapshot.get(class_id, {}), timetable.slots.get(key, ()))
+        rendered.media[key] = media
+    return media
+
+async def send_media(message: Message, media: tuple):
+    # Только file_id: Telegram отдаёт уже загруженные файлы, объём отправки не зависит от их размера
+    for group in media:
+        if len(group) == 1:
+            item = group[0]
+            if isinstance(item, InputMediaPhoto):
+                await message.answer_photo(item.media, caption=item.caption)
+            else:
+                await message.answer_document(item.media, caption=item.caption)
+        else:
+            await message.answer_media_group(list(group))
+
+def rendered_full(rendered: Rendered, class_id: int, variant: int, parity: int) -> str:
+    key = (class_id, variant, parity)
+    text = rendered.full.get(key)
+    if text is None:
+        text = "".join(rendered_day(rendered, class_id, variant, parity, d) + "\n" for d in range(len(DAYS)))
+        rendered.full[key] = text
+    return text
+
+# -------------------------
+# Рассылка уведомлений о новом ДЗ
+# -------------------------
+# BROADCAST_ON_UPDATE=1: после add_dz_save пишем всем, у кого в варианте есть этот предмет.
+# Получателей читаем курсором на стороне сервера, отправляем с ограничением скорости,
+# прогресс сохраняем в Broadcasts — после рестарта рассылка продолжится с того же места.
+BROADCAST_ON_UPDATE = getenv("BROADCAST_ON_UPDATE", "0") == "1"
+BROADCAST_RATE = float(getenv("BROADCAST_RATE", "25"))            # сообщений/с на весь бот (лимит Telegram ~30)
+BROADCAST_CHAT_INTERVAL = float(getenv("BROADCAST_CHAT_INTERVAL", "1"))  # не чаще раза в секунду в один чат
+BROADCAST_PREFETCH = 500        # сколько получателей курсор тянет за раз
+BROADCAST_CHECKPOINT = 50       # как часто сохраняем прогресс
+BROADCAST_MAX_ATTEMPTS = 5      # попыток на одно сообщение при сетевых ошибках
+BROADCAST_PREVIEW_MAX = 1000    # сколько текста ДЗ кладём в уведомление (лимит Telegram — 4096)
+# Ошибки самого текста, а не получателя: остальным он тоже не уйдёт
+BROADCAST_FATAL_ERRORS = ("message is too long", "can't parse entities", "text must be non-empty")
+
+class BroadcastAborted(Exception):
+    pass
+
+def broadcast_preview(text: str) -> str:
+    return text if len(text) <= BROADCAST_PREVIEW_MAX else text[:BROADCAST_PREVIEW_MAX].rstrip() + "…"
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def try_take(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    async def take(self):
+        while not self.try_take():
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+_broadcast_bucket = TokenBucket(BROADCAST_RATE, BROADCAST_RATE)
+_broadcast_chat_sent = OrderedDict()  # chat_id -> время последней отправки (только свежие)
+_broadcast_lock = asyncio.Lock()      # рассылки идут по одной — так проще держать лимиты
+_broadcast_tasks = {}                 # broadcast_id -> task
+
+def variants_with_subject(class_id: int, subject: str) -> list:
+    return sorted({variant for (cls, variant, _, _), lessons in timetable.slots.items()
+                   if cls == class_id and subject in lessons})
+
+async def _wait_chat_slot(chat_id: int):
+    now = time.monotonic()
+    # Выкидываем записи старше интервала — словарь не растёт с числом получателей
+    while _broadcast_chat_sent:
+        oldest_chat, sent_at = next(iter(_broadcast_chat_sent.items()))
+        if now - sent_at < BROADCAST_CHAT_INTERVAL:
+            break
+        del _broadcast_chat_sent[oldest_chat]
+    sent_at = _broadcast_chat_sent.get(chat_id)
+    if sent_at is not None:
+        await asyncio.sleep(BROADCAST_CHAT_INTERVAL - (now - sent_at))
+
+async def _send_broadcast_message(chat_id: int, text: str) -> bool:
+    attempt = 0
+    while True:
+        await _wait_chat_slot(chat_id)
+        await _broadcast_bucket.take()
+        try:
+            await bot.send_message(chat_id, text, parse_mode="HTML")
+            _broadcast_chat_sent.pop(chat_id, None)
+            _broadcast_chat_sent[chat_id] = time.monotonic()
+            return True
+        except TelegramRetryAfter as e:
+            logger.warning(f"Broadcast hit flood limit, sleeping {e.retry_after}s")
+            await asyncio.sleep(e.retry_after)
+        except TelegramForbiddenError as e:
+            # Бот заблокирован — повторять бессмысленно
+            logger.info(f"Broadcast to {chat_id} skipped: {e}")
+            return False
+        except TelegramBadRequest as e:
+            if any(error in str(e).lower() for error in BROADCAST_FATAL_ERRORS):
+                raise BroadcastAborted(str(e)) from e
+            # Чата больше нет — пропускаем только этого получателя
+            logger.info(f"Broadcast to {chat_id} skipped: {e}")
+            return False
+        except TelegramNetworkError as e:
+            attempt += 1
+            if attempt >= BROADCAST_MAX_ATTEMPTS:
+                logger.error(f"Broadcast to {chat_id} failed after {attempt} attempts: {e}")
+                return False
+            await asyncio.sleep(attempt)
+
+async def _save_broadcast_progress(broadcast_id: int, last_user_id: int, sent: int, failed: int, done: bool = False):
+    async with db_acquire() as conn:
+        await conn.execute(
+            "UPDATE Broadcasts SET last_user_id=$2, sent=$3, failed=$4, done=$5 WHERE id=$1",
+            broadcast_id, last_user_id, sent, failed, done
+        )
+
+async def _broadcast_recipients(conn, broadcast_id: int, row) -> tuple:
+    last_user_id, sent, failed = row["last_user_id"], row["sent"], row["failed"]
+    logger.info(f"Broadcast {broadcast_id} started from user_id>{last_user_id} (sent={sent})")
+    unsaved = 0
+    finished = False
+    try:
+        # Курсор живёт только внутри транзакции; прогресс пишем через другое соединение
+        async with conn.transaction(isolation="repeatable_read", readonly=True):
+            cursor = conn.cursor(
+                "SELECT user_id FROM UserInfo "
+                "WHERE user_option = ANY($1::int[]) AND user_id > $2 AND COALESCE(class_id, $4) = $3 "
+                "ORDER BY user_id",
+                row["variants"], last_user_id, row["class_id"] or timetable.default_class_id,
+                timetable.default_class_id, prefetch=BROADCAST_PREFETCH
+            )
+            async for recipient in cursor:
+                if await _send_broadcast_message(recipient["user_id"], row["text"]):
+                    sent += 1
+                else:
+                    failed += 1
+                last_user_id = recipient["user_id"]
+                unsaved += 1
+                if unsaved >= BROADCAST_CHECKPOINT:
+                    await _save_broadcast_progress(broadcast_id, last_user_id, sent, failed)
+                    unsaved = 0
+        finished = True
+    except BroadcastAborted as e:
+        # Текст не уйдёт никому — не сжигаем аудиторию и не возобновляем после рестарта
+        logger.error(f"Broadcast {broadcast_id} aborted at user_id>{last_user_id}: {e}")
+        finished = True
+    finally:
+        if finished or unsaved:
+            await _save_broadcast_progress(broadcast_id, last_user_id, sent, failed, done=finished)
+    return sent, failed
+
+async def run_broadcast(broadcast_id: int):
+    async with _broadcast_lock:
+        async with db_acquire() as conn:
+            # Одну рассылку ведёт ровно один процесс; если он умрёт, блокировка снимется сама
+            locked = await conn.fetchval(
+                "SELECT pg_try_advisory_lock(hashtext('broadcast'), $1::int)", broadcast_id
+            )
+            if not locked:
+                return
+            try:
+                row = await conn.fetchrow(
+                    "SELECT text, variants, class_id, last_user_id, sent, failed FROM Broadcasts WHERE id=$1 AND NOT done",
+                    broadcast_id
+                )
+                if row is None:
+                    return
+                sent, failed = await _broadcast_recipients(conn, broadcast_id, row)
+            finally:
+                await conn.execute("SELECT pg_advisory_unlock(hashtext('broadcast'), $1::int)", broadcast_id)
+    logger.info(f"Broadcast {broadcast_id} finished: sent={sent} failed={failed}")
+
+def start_broadcast(broadcast_id: int):
+    if broadcast_id in _broadcast_tasks:
+        return
+    task = asyncio.create_task(run_broadcast(broadcast_id))
+    _broadcast_tasks[broadcast_id] = task
+    task.add_done_callback(lambda _: _broadcast_tasks.pop(broadcast_id, None))
+
+async def resume_broadcasts():
+    async with db_acquire() as conn:
+        rows = await conn.fetch("SELECT id FROM Broadcasts WHERE NOT done ORDER BY id")
+    for row in rows:
+        if row["id"] not in _broadcast_tasks:
+            logger.info(f"Resuming broadcast {row['id']}")
+            start_broadcast(row["id"])
+
+async def broadcast_resume_loop():
+    # Подхватываем рассылки, брошенные упавшими процессами
+    while True:
+        try:
+            await resume_broadcasts()
+        except Exception as e:
+            logger.error(f"Broadcast resume failed: {e!r}")
+        await asyncio.sleep(60)
+
+async def stop_broadcasts():
+    # Прогресс сохранится в finally, остаток дошлём после рестарта
+    tasks = list(_broadcast_tasks.values())
+    for task in tasks:
+        task.cancel()
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+
 # -------------------------
 # Health-check (чтобы не было 404 при keep-alive)
 # -------------------------
@@ -179,6 +1251,7 @@ async def root():
 KEEP_ALIVE_URL = BASE_URL  # ping root health-check
 
 async def keep_awake():
+    import httpx  # нужен только лидеру — не тянем при старте каждого процесса
     while True:
         try:
             async with httpx.AsyncClient() as client:
@@ -188,6 +1261,118 @@ async def keep_awake():
             logger.error(f"Ошибка keep-alive: {e}")
         await asyncio.sleep(600)  # 10 минут
 
+# -------------------------
+# Асинхронная обработка апдейтов
+# -------------------------
+# В режиме WEBHOOK_ASYNC=1 вебхук только ставит апдейт в очередь и сразу отвечает 200.
+# Апдейты одного чата всегда попадают в одну очередь — порядок внутри чата сохраняется,
+# разные чаты обрабатываются параллельно.
+WEBHOOK_ASYNC = getenv("WEBHOOK_ASYNC", "0") == "1"
+UPDATE_WORKERS = int(getenv("UPDATE_WORKERS", "8"))
+UPDATE_QUEUE_SIZE = int(getenv("UPDATE_QUEUE_SIZE", "100"))            # на одну очередь
+UPDATE_ENQUEUE_TIMEOUT = float(getenv("UPDATE_ENQUEUE_TIMEOUT", "1"))   # сколько ждём места в очереди
+UPDATE_DRAIN_TIMEOUT = float(getenv("UPDATE_DRAIN_TIMEOUT", "10"))      # сколько дорабатываем при остановке
+
+_update_queues = []
+_update_workers = []
+UPDATES_DROPPED = Counter("bot_updates_dropped_total", "Updates shed because the worker queue was full")
+
+def _update_chat_id(update: Update) -> int:
+    if update.message:
+        return update.message.chat.id
+    if update.callback_query:
+        query = update.callback_query
+        return query.message.chat.id if query.message else query.from_user.id
+    return 0
+
+async def feed_update(update: Update):
+    # Счётчик ставим до dp.feed_update: иначе мимо него прошли бы запросы
+    # встроенных middleware aiogram (FSM читает состояние раньше наших)
+    counter = db_roundtrips.get()
+    token = None
+    if counter is None:
+        # Бенчмарк может выставить свой счётчик до вызова вебхука
+        counter = [0]
+        token = db_roundtrips.set(counter)
+    try:
+        await dp.feed_update(bot, update)
+    finally:
+        logger.debug(f"Update {update.update_id}: {counter[0]} DB round-trips")
+        DB_ROUNDTRIPS.observe(counter[0])
+        if token is not None:
+            db_roundtrips.reset(token)
+
+async def _update_worker(queue: asyncio.Queue):
+    while True:
+        update = await queue.get()
+        try:
+            if update is None:
+                return  # сигнал остановки
+            await feed_update(update)
+        except Exception as e:
+            UPDATES_TOTAL.inc("failed")
+            logger.exception(f"Update {update.update_id} failed: {e}")
+        finally:
+            queue.task_done()
+
+def start_update_workers():
+    for _ in range(UPDATE_WORKERS):
+        queue = asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE)
+        _update_queues.append(queue)
+        _update_workers.append(asyncio.create_task(_update_worker(queue)))
+    logger.info(f"Update workers started: {UPDATE_WORKERS} x queue {UPDATE_QUEUE_SIZE}")
+
+async def enqueue_update(update: Update) -> bool:
+    queue = _update_queues[_update_chat_id(update) % len(_update_queues)]
+    try:
+        queue.put_nowait(update)
+        return True
+    except asyncio.QueueFull:
+        pass
+    # Очередь забита: немного притормаживаем вебхук, потом сбрасываем нагрузку
+    try:
+        await asyncio.wait_for(queue.put(update), UPDATE_ENQUEUE_TIMEOUT)
+        return True
+    except asyncio.TimeoutError:
+        UPDATES_DROPPED.inc()
+        logger.warning(f"Update queue full, dropped update {update.update_id} (total dropped: {UPDATES_DROPPED.value():.0f})")
+        return False
+
+async def stop_update_workers():
+    if not _update_workers:
+        return
+
+    async def drain(queue: asyncio.Queue, worker: asyncio.Task):
+        # Сигнал остановки встаёт в конец очереди; если очередь забита, ждём места
+        await queue.put(None)
+        await worker
+
+    # Один общий срок на всё: зависший воркер с полной очередью не должен держать остановку
+    drains = [asyncio.create_task(drain(queue, worker)) for queue, worker in zip(_update_queues, _update_workers)]
+    done, pending = await asyncio.wait(drains, timeout=UPDATE_DRAIN_TIMEOUT)
+    for task in pending:
+        task.cancel()
+    for worker in _update_workers:
+        worker.cancel()
+    if pending:
+        left = sum(queue.qsize() for queue in _update_queues)
+        logger.warning(f"Update workers did not drain in {UPDATE_DRAIN_TIMEOUT}s, ~{left} updates lost")
+    _update_workers.clear()
+    _update_queues.clear()
+
+# -------------------------
+# Разбор апдейтов
+# -------------------------
+# Типы апдейтов, на которые есть обработчики (заполняется в startup)
+handled_update_types = frozenset()
+
+def is_handled_update(raw: dict) -> bool:
+    return any(key in handled_update_types for key in raw if key != "update_id")
+
+def build_update(raw: dict) -> Update:
+    # Сразу привязываем бота: иначе feed_update пересоберёт апдейт ещё раз через model_dump
+    return Update.model_validate(raw, context={"bot": bot})
+
 # -------------------------
 # Webhook endpoint
 # -------------------------
@@ -195,55 +1380,321 @@ async def keep_awake():
 async def telegram_webhook(request: Request):
     if bot is None:
         logger.error("Bot not initialized yet, received update")
+        UPDATES_TOTAL.inc("not_ready")
         return {"ok": False}
+    started = time.perf_counter()
     try:
-        raw = await request.json()
+        raw = _json_loads(await request.body())
         logger.info(f"Incoming webhook: {raw.get('update_id')}")
-        update = Update.model_validate(raw)  # строгая валидация
-        await dp.feed_update(bot, update)   # <-- ВАЖНО: дожидаемся обработки
+        if not is_handled_update(raw):
+            UPDATES_TOTAL.inc("ignored")
+            return {"ok": True}  # обработчиков на такой тип нет — не тратим время на валидацию
+        update = build_update(raw)
+        if WEBHOOK_ASYNC:
+            # Отвечаем Telegram сразу, обработка — в воркерах
+            queued = await enqueue_update(update)
+            UPDATES_TOTAL.inc("queued" if queued else "dropped")
+            return {"ok": queued}
+        await feed_update(update)   # <-- ВАЖНО: дожидаемся обработки
+        UPDATES_TOTAL.inc("processed")
         return {"ok": True}
     except Exception as e:
+        UPDATES_TOTAL.inc("failed")
         logger.exception(f"Webhook error: {e}")
         return {"ok": False}
+    finally:
+        WEBHOOK_SECONDS.observe(time.perf_counter() - started)
 
 # -------------------------
-# Startup / Shutdown
+# Метрики: endpoint и замеры
 # -------------------------
-@app.on_event("startup")
-async def on_startup():
-    global bot
-    logger.info("Starting up: init DB, bot, webhook, keep-alive")
-    await init_db_with_retry()
+Gauge("bot_db_pool_size", "Open connections in the asyncpg pool", lambda: pool.get_size())
+Gauge("bot_db_pool_idle", "Idle connections in the asyncpg pool", lambda: pool.get_idle_size())
+Gauge("bot_db_pool_max_size", "Maximum asyncpg pool size", lambda: pool.get_max_size())
+Gauge("bot_update_queue_depth", "Updates waiting in worker queues",
+      lambda: sum(queue.qsize() for queue in _update_queues))
+Gauge("bot_is_leader", "1 if this instance holds leadership", lambda: int(is_leader))
+
+@app.get("/metrics")
+async def metrics():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.expose())
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+async def bot_api_metrics_middleware(make_request, bot, method):
+    name = method.__api_method__
+    started = time.perf_counter()
+    try:
+        return await make_request(bot, method)
+    except Exception as e:
+        BOT_API_ERRORS.inc(name, type(e).__name__)
+        raise
+    finally:
+        BOT_API_SECONDS.observe(time.perf_counter() - started, name)
+
+# -------------------------
+# Профилировщик по запросу
+# -------------------------
+# GET /debug/profile?seconds=10&updates=100 с заголовком X-Profile-Token: отдельный поток
+# снимает стек потока event loop через sys._current_frames() и копит collapsed stacks
+# (формат flamegraph.pl / speedscope). format=json добавляет время обработчиков aiogram.
+# Без PROFILE_TOKEN endpoint выключен.
+PROFILE_TOKEN = getenv("PROFILE_TOKEN")
+PROFILE_MAX_SECONDS = 120
+PROFILE_MAX_DEPTH = 128
+
+class SamplingProfiler:
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}     # "корень;...;лист" -> число выборок
+        self.handlers = {}   # обработчик -> [вызовов, суммарно с, максимум с]
+        self.samples = 0
+        self.updates = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None and len(names) < PROFILE_MAX_DEPTH:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if not names:
+                continue
+            stack = ";".join(reversed(names))
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            self.samples += 1
+
+    def record_handler(self, name: str, seconds: float):
+        stats = self.handlers.setdefault(name, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] = max(stats[2], seconds)
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(self.stacks.items()))
+
+_profiler = None
+
+@dp.update.outer_middleware()
+async def profile_updates_middleware(handler, event: Update, data: dict):
+    try:
+        return await handler(event, data)
+    finally:
+        if _profiler is not None:
+            _profiler.updates += 1
+
+@app.get("/debug/profile")
+async def debug_profile(request: Request, seconds: float = 10, updates: int = 0,
+                        interval: float = 0.005, format: str = "collapsed"):
+    global _profiler
+    # Только заголовок: параметр запроса осел бы в логах uvicorn и прокси
+    token = request.headers.get("X-Profile-Token") or ""
+    if not PROFILE_TOKEN or not hmac.compare_digest(token.encode(), PROFILE_TOKEN.encode()):
+        return PlainTextResponse("Not found\n", status_code=404)
+    if _profiler is not None:
+        return PlainTextResponse("Profiling already in progress\n", status_code=409)
+    seconds = min(max(seconds, 0.1), PROFILE_MAX_SECONDS)
+    profiler = SamplingProfiler(threading.get_ident(), max(interval, 0.001))
+    _profiler = profiler
+    profiler.start()
+    started = time.perf_counter()
+    deadline = time.monotonic() + seconds
+    try:
+        # Сами обработчики крутятся в этом же loop — просто ждём, пока наберётся нужное
+        while time.monotonic() < deadline and not (updates and profiler.updates >= updates):
+            await asyncio.sleep(0.05)
+    finally:
+        _profiler = None
+        profiler.stop()
+    elapsed = time.perf_counter() - started
+    logger.info(f"Profile taken: {elapsed:.1f}s, {profiler.samples} samples, {profiler.updates} updates")
+    if format == "json":
+        return {
+            "seconds": round(elapsed, 3),
+            "interval": profiler.interval,
+            "samples": profiler.samples,
+            "updates": profiler.updates,
+            "handlers": {
+                name: {"calls": calls, "total_ms": round(total * 1000, 3),
+                       "avg_ms": round(total * 1000 / calls, 3), "max_ms": round(worst * 1000, 3)}
+                for name, (calls, total, worst) in sorted(profiler.handlers.items(), key=lambda i: -i[1][1])
+            },
+            "collapsed": profiler.collapsed(),
+        }
+    return PlainTextResponse(profiler.collapsed())
+
+# -------------------------
+# Выбор лидера
+# -------------------------
+# Вебхук и фоновые задачи (keep-alive, рассылки, чистка FSM) нужны в одном экземпляре.
+# Лидер держит advisory lock на отдельном соединении; если процесс умрёт,
+# Postgres снимет блокировку, и её заберёт кто-то из остальных.
+LEADER_LOCK_NAME = "bot_leader"
+LEADER_CHECK_INTERVAL = float(getenv("LEADER_CHECK_INTERVAL", "15"))
+
+is_leader = False
+_leader_task = None
+
+ALLOWED_UPDATES = ["message", "callback_query"]
+
+# Ответ getWebhookInfo, полученный при быстром старте параллельно с подключением к БД.
+# Годится, только если лидерство взято с первой попытки; иначе его сбрасывает leader_loop
+_startup_webhook_info = None
+
+async def fetch_webhook_info():
+    try:
+        return await bot.get_webhook_info()
+    except Exception as e:
+        logger.error(f"get_webhook_info failed: {e}")
+        return None
 
-    bot = Bot(token=TOKEN)
+def webhook_is_current(info) -> bool:
+    return (info is not None and info.url == WEBHOOK_URL
+            and set(info.allowed_updates or []) == set(ALLOWED_UPDATES))
+
+async def setup_webhook():
+    global _startup_webhook_info
+    if FAST_START:
+        info, _startup_webhook_info = _startup_webhook_info, None
+        if info is None:
+            info = await fetch_webhook_info()
+        if webhook_is_current(info):
+            logger.info(f"Webhook already set to {WEBHOOK_URL}, pending={info.pending_update_count}")
+            return
 
-    # Переустанавливаем вебхук жёстко
+    # Накопленные у Telegram апдейты не выбрасываем: лидер мог смениться на ходу
     await bot.set_webhook(
         WEBHOOK_URL,
-        drop_pending_updates=True,
-        allowed_updates=["message", "callback_query"]
+        drop_pending_updates=False,
+        allowed_updates=ALLOWED_UPDATES
     )
     logger.info(f"Webhook set to {WEBHOOK_URL}")
 
     # Диагностика: что видит Telegram
-    try:
-        info = await bot.get_webhook_info()
+    info = await fetch_webhook_info()
+    if info is not None:
         logger.info(f"Webhook info: url={info.url!r} pending={info.pending_update_count} last_error_date={getattr(info, 'last_error_date', None)} last_error_message={getattr(info,'last_error_message', None)}")
-    except Exception as e:
-        logger.error(f"get_webhook_info failed: {e}")
 
-    asyncio.create_task(keep_awake())
+async def start_leader_jobs() -> list:
+    await setup_webhook()
+    jobs = [
+        asyncio.create_task(keep_awake()),
+        asyncio.create_task(broadcast_resume_loop()),
+    ]
+    if isinstance(storage, PostgresStorage):
+        jobs.append(asyncio.create_task(fsm_cleanup_loop()))
+    return jobs
+
+async def leader_loop():
+    global is_leader, _startup_webhook_info
+    while True:
+        conn = None
+        try:
+            conn = await asyncpg.connect(_db_dsn(), ssl=_db_ssl)
+            while not await conn.fetchval("SELECT pg_try_advisory_lock(hashtext($1))", LEADER_LOCK_NAME):
+                # Лидерство досталось не сразу — ответ, полученный при старте, к тому времени устареет
+                _startup_webhook_info = None
+                await asyncio.sleep(LEADER_CHECK_INTERVAL)
+            is_leader = True
+            logger.info(f"Instance {INSTANCE_ID} is the leader")
+            jobs = []
+            try:
+                jobs = await start_leader_jobs()
+                # Проверяем, что соединение (а с ним и блокировка) ещё живо
+                while True:
+                    await asyncio.sleep(LEADER_CHECK_INTERVAL)
+                    await asyncio.wait_for(conn.fetchval("SELECT 1"), LEADER_CHECK_INTERVAL)
+            finally:
+                is_leader = False
+                for job in jobs:
+                    job.cancel()
+                logger.warning(f"Instance {INSTANCE_ID} stepped down from leadership")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Leader election error: {e!r}. Retry in {LEADER_CHECK_INTERVAL}s")
+        finally:
+            if conn is not None and not conn.is_closed():
+                try:
+                    await conn.close()
+                except Exception:
+                    pass
+        await asyncio.sleep(LEADER_CHECK_INTERVAL)
+
+# -------------------------
+# Startup / Shutdown
+# -------------------------
+def make_bot() -> Bot:
+    if TELEGRAM_API_URL:
+        session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL))
+    else:
+        session = AiohttpSession()
+    session.middleware(bot_api_metrics_middleware)
+    return Bot(token=TOKEN, session=session)
+
+async def _timed_phase(name: str, coro):
+    started = time.perf_counter()
+    try:
+        return await coro
+    finally:
+        logger.info(f"Startup phase {name}: {(time.perf_counter() - started) * 1000:.0f} ms")
+
+@app.on_event("startup")
+async def on_startup():
+    global bot, _listener_task, _leader_task, handled_update_types, _startup_webhook_info
+    logger.info("Starting up: init DB, bot, webhook, keep-alive")
+    started = time.perf_counter()
+
+    bot = make_bot()
+    handled_update_types = frozenset(dp.resolve_used_update_types())
+
+    if FAST_START:
+        # Telegram и БД опрашиваем одновременно; вебхук лидер сверит с уже полученным ответом
+        _, _startup_webhook_info = await asyncio.gather(
+            _timed_phase("db_init", init_db_with_retry()),
+            _timed_phase("webhook_info", fetch_webhook_info()),
+        )
+    else:
+        await _timed_phase("db_init", init_db_with_retry())
+    await _timed_phase("timetable", load_timetable())
+    await _timed_phase("homework_snapshot", get_rendered())
+    _listener_task = asyncio.create_task(notify_listener())
+
+    if WEBHOOK_ASYNC:
+        start_update_workers()
+
+    # Вебхук и фоновые задачи — только у лидера
+    _leader_task = asyncio.create_task(leader_loop())
+    logger.info(f"Startup finished in {(time.perf_counter() - started) * 1000:.0f} ms, ready for updates")
 
 @app.on_event("shutdown")
 async def on_shutdown():
     logger.info("Shutting down: closing resources")
+    # Сначала дорабатываем очередь — обработчикам ещё нужны БД и бот
+    await stop_update_workers()
+    # Отдаём лидерство: задачи лидера останавливаются, блокировка снимается с закрытием соединения.
+    # Вебхук не удаляем — остальные экземпляры продолжают принимать апдейты
+    if _leader_task:
+        _leader_task.cancel()
+        await asyncio.gather(_leader_task, return_exceptions=True)
+    await stop_broadcasts()
+    if _listener_task:
+        _listener_task.cancel()
     if pool:
         await pool.close()
     if bot:
-        try:
-            await bot.delete_webhook()
-        except Exception as e:
-            logger.error(f"Error deleting webhook: {e}")
         try:
             await bot.session.close()
         except Exception:
@@ -260,7 +1711,7 @@ async def on_shutdown():
 async def command_start_handler(message: Message):
     if pool is None:
         raise RuntimeError("Пул базы данных ещё не инициализирован")
-    async with pool.acquire() as conn:
+    async with db_acquire() as conn:
         await conn.execute(
             "INSERT INTO UserInfo (user_id, user_name) VALUES ($1, $2) "
             "ON CONFLICT (user_id) DO NOTHING",
@@ -276,68 +1727,62 @@ async def command_start_handler(message: Message):
 
     await message.answer(text, parse_mode="HTML", reply_markup=get_main_menu(message.from_user.id))
 
-async def get_user_option(user_id: int):
+def _profile(row) -> tuple:
+    # (класс, вариант); класс всегда валидный, вариант может быть None
+    if row is None:
+        return resolve_class(None), None
+    return resolve_class(row["class_id"]), row["user_option"]
+
+async def get_user_profile(user_id: int) -> tuple:
     if pool is None:
         raise RuntimeError("Пул базы данных ещё не инициализирован")
-    async with pool.acquire() as conn:
+    async with db_acquire() as conn:
         row = await conn.fetchrow(
-            "SELECT user_option FROM UserInfo WHERE user_id=$1", user_id
+            "SELECT user_option, class_id FROM UserInfo WHERE user_id=$1", user_id
         )
-        return row["user_option"] if row else None
+    return _profile(row)
 
-async def get_homework_for_day(user_id: int, day_index: int):
-    if pool is None:
-        raise RuntimeError("Пул базы данных ещё не инициализирован")
-    user_option = await get_user_option(user_id)
-    if not user_option:
-        return "❌ Сначала выбери вариант через кнопку '🔄 Сменить вариант группы'"
-    
-    DZ = DZ_VAR1 if user_option == 1 else DZ_VAR2
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT * FROM Dz_Table WHERE id=1")
-    
-    result = f"<b><u>{['Понедельник','Вторник','Среда','Четверг','Пятница'][day_index]} — Вариант {user_option}</u></b>\n\n"
-    for i, subj in enumerate(DZ[day_index], start=1):
-        if subj == "-":
-            result += f"<b>{i}. ❌ Нет урока</b>\n"
-        else:
-            hw = row[subj]
-            date = row[f"{subj}_date"]
-            result += f"<b>{i}. {html.quote(subj)} — {html.quote(hw)}</b>"
-            if date:
-                result += f" [{date}]"
-            result += "\n"
-    return result
+# Последний известный профиль: если БД недоступна, кнопки отвечают из него и снапшота ДЗ
+PROFILE_CACHE_MAX = 10000
+_profiles = OrderedDict()   # user_id -> (класс, вариант)
 
+def remember_profile(user_id: int, profile: tuple):
+    _lru_put(_profiles, user_id, profile, PROFILE_CACHE_MAX)
 
-async def get_full_schedule(user_id: int):
-    if pool is None:
-        raise RuntimeError("Пул базы данных ещё не инициализирован")
-    user_option = await get_user_option(user_id)
-    if not user_option:
-        return "❌ Сначала выбери вариант через кнопку '🔄 Сменить вариант группы'"
-    
-    DZ = DZ_VAR1 if user_option == 1 else DZ_VAR2
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT * FROM Dz_Table WHERE id=1")
-    
-    result = ""
-    days = ["Понедельник","Вторник","Среда","Четверг","Пятница"]
-    for i, day in enumerate(days):
-        subjects_day = DZ[i]
-        result += f"<b><u>{day} — Вариант {user_option}</u></b>\n\n"
-        for j, subj in enumerate(subjects_day, start=1):
-            if subj == "-":
-                result += f"<b>{j}. ❌ Нет урока</b>\n"
-            else:
-                hw = row[subj]
-                date = row[f"{subj}_date"]
-                result += f"<b>{j}. {html.quote(subj)} — {html.quote(hw)}</b>"
-                if date:
-                    result += f" [{date}]"
-                result += "\n"
-        result += "\n"
-    return result
+async def touch_user_profile(user: User) -> tuple:
+    # То же, что get_user_profile, но заодно создаёт/обновляет строку пользователя
+    try:
+        if pool is None:
+            raise RuntimeError("Пул базы данных ещё не инициализирован")
+        async with db_acquire() as conn:
+            row = await conn.fetchrow(TOUCH_USER_SQL, user.id, user.first_name)
+    except Exception as e:
+        cached = _profiles.get(user.id)
+        if cached is None:
+            raise
+        logger.warning(f"Profile lookup failed, serving cached profile for {user.id}: {e!r}")
+        return resolve_class(cached[0]), cached[1]
+    profile = _profile(row)
+    remember_profile(user.id, profile)
+    return profile
+
+async def get_homework_for_day(profile: tuple, day: datetime.date):
+    # (текст, альбомы вложений)
+    class_id, user_option = profile
+    if user_option not in timetable.class_variants.get(class_id, ()):
+        return NO_OPTION_TEXT, ()
+    rendered = await get_rendered()
+    key = (class_id, user_option, week_parity(day), day.weekday())
+    return rendered_day(rendered, *key), rendered_media(rendered, *key)
+
+
+async def get_full_schedule(profile: tuple, week: datetime.date = None):
+    class_id, user_option = profile
+    if user_option not in timetable.class_variants.get(class_id, ()):
+        return NO_OPTION_TEXT
+    rendered = await get_rendered()
+    week = week or next_school_day(datetime.date.today())
+    return rendered_full(rendered, class_id, user_option, week_parity(week))
 
 
 # -------------------------
@@ -349,9 +1794,14 @@ async def add_dz_start(message: Message, state: FSMContext):
         await message.answer("⛔ У тебя нет прав добавлять дз.")
         return
 
+    # ДЗ пишется для класса, в котором состоит сам админ
+    class_id, _ = await get_user_profile(message.from_user.id)
+    # Вложения от брошенной прошлой попытки к новому ДЗ не относятся
+    async with db_acquire() as conn:
+        await conn.execute("DELETE FROM PendingAttachments WHERE user_id=$1", message.from_user.id)
     keyboard_rows = []
     row = []
-    for i, subj in enumerate(subjects, start=1):
+    for i, subj in enumerate(class_subject_list(class_id), start=1):
         row.append(KeyboardButton(text=subj))
         if i % 2 == 0:
             keyboard_rows.append(row)
@@ -361,16 +1811,19 @@ async def add_dz_start(message: Message, state: FSMContext):
     keyboard_rows.append([KeyboardButton(text="Отмена")])
     keyboard = ReplyKeyboardMarkup(keyboard=keyboard_rows, resize_keyboard=True)
     await state.set_state(DzStates.choosing_subject)
+    # Начинаем с чистых данных: подпись брошенной попытки не должна попасть в новое ДЗ
+    await state.set_data({"class_id": class_id})
     await message.answer("📚 Выбери предмет:", reply_markup=keyboard)
 
 @dp.message(DzStates.choosing_subject)
 async def add_dz_subject(message: Message, state: FSMContext):
-    if message.text.strip() == "Отмена":
+    subject = (message.text or "").strip()
+    if subject == "Отмена":
         await state.clear()
         await message.answer("❌ Добавление ДЗ отменено.", reply_markup=get_main_menu(message.from_user.id))
         return
-    subject = message.text.strip()
-    if subject not in subjects:
+    data = await state.get_data()
+    if subject not in timetable.class_subjects.get(data.get("class_id"), ()):
         await message.answer("⚠ Такого предмета нет. Выбери из списка.")
         return
     await state.update_data(subject=subject)
@@ -378,26 +1831,523 @@ async def add_dz_subject(message: Message, state: FSMContext):
     await message.answer(f"✏ Запиши новое ДЗ по предмету: <b>{subject}</b>",
                          parse_mode="HTML", reply_markup=ReplyKeyboardRemove())
 
+ATTACH_DONE = "Готово"
+
+@dp.message(DzStates.writing_homework, lambda m: m.photo or m.document)
+async def add_dz_attachment(message: Message, state: FSMContext):
+    if message.photo:
+        # Telegram присылает несколько размеров одного фото — берём самый большой
+        kind, file = "photo", message.photo[-1]
+    else:
+        kind, file = "document", message.document
+    # Части альбома приходят почти одновременно и могут попасть в разные воркеры,
+    # поэтому добавляем строкой в БД, а не правкой списка в данных FSM
+    async with db_acquire() as conn:
+        added = await conn.fetchval(
+            """
+            INSERT INTO PendingAttachments (user_id, kind, file_id, file_unique_id)
+            SELECT $1, $2, $3, $4
+            WHERE (SELECT count(*) FROM PendingAttachments WHERE user_id = $1) < $5
+            ON CONFLICT (user_id, file_unique_id) DO NOTHING
+            RETURNING id
+            """,
+            message.from_user.id, kind, file.file_id, file.file_unique_id, MEDIA_GROUP_MAX
+        )
+        if added is None:
+            if await conn.fetchval("SELECT count(*) FROM PendingAttachments WHERE user_id=$1",
+                                   message.from_user.id) >= MEDIA_GROUP_MAX:
+                await message.answer(f"⚠ Не больше {MEDIA_GROUP_MAX} вложений на одно ДЗ.")
+            return  # иначе тот же файл уже прикреплён
+    if message.caption:
+        # Подпись в альбоме только у одной части — гонки за это поле нет
+        await state.update_data(caption=message.caption.strip())
+    # На каждую часть альбома не отвечаем — только на подписанную
+    if message.media_group_id is None or message.caption:
+        keyboard = ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text=ATTACH_DONE)]], resize_keyboard=True)
+        await message.answer("📎 Вложение добавлено. Пришли текст ДЗ или нажми «Готово».", reply_markup=keyboard)
+
 @dp.message(DzStates.writing_homework)
 async def add_dz_save(message: Message, state: FSMContext):
-    hw_text = message.text.strip()
     data = await state.get_data()
+    hw_text = (message.text or "").strip()
+    if not hw_text:
+        await message.answer("✏ Пришли текст ДЗ, фото или файл.")
+        return
     subject = data.get("subject")
-    today = datetime.datetime.today()
-    RUS_DAYS = ["Понедельник","Вторник","Среда","Четверг","Пятница","Суббота","Воскресенье"]
-    RUS_MONTHS = ["Января","Февраля","Марта","Апреля","Мая","Июня",
-                  "Июля","Августа","Сентября","Октября","Ноября","Декабря"]
-    date_str = f"{RUS_DAYS[today.weekday()]}, {today.day} {RUS_MONTHS[today.month-1]}"
+    class_id = data.get("class_id") or timetable.default_class_id
+    today = datetime.date.today()
+    date_str = format_hw_date(today)
     if pool is None:
         raise RuntimeError("Пул базы данных ещё не инициализирован")
-    async with pool.acquire() as conn:
-        await conn.execute(f'UPDATE Dz_Table SET "{subject}"=$1, "{subject}_date"=$2 WHERE id=1',
-                       hw_text, date_str)
+    broadcast_id = None
+    async with db_acquire() as conn:
+        if hw_text == ATTACH_DONE and not await conn.fetchval(
+                "SELECT EXISTS (SELECT 1 FROM PendingAttachments WHERE user_id=$1)", message.from_user.id):
+            await message.answer("✏ Вложений нет — пришли текст ДЗ, фото или файл.")
+            return
+        async with conn.transaction():
+            pending = await conn.fetch(
+                "DELETE FROM PendingAttachments WHERE user_id=$1 RETURNING id, kind, file_id, file_unique_id",
+                message.from_user.id
+            )
+            attachments = sorted(pending, key=lambda a: a["id"])[:MEDIA_GROUP_MAX]
+            if hw_text == ATTACH_DONE and attachments:
+                hw_text = data.get("caption") or "См. вложение"
+            homework_id = await conn.fetchval(
+                "INSERT INTO Homework (class_id, subject_id, body, hw_date) "
+                "SELECT $4, id, $2, $3 FROM Subjects WHERE name = $1 RETURNING id",
+                subject, hw_text, today, class_id
+            )
+            await conn.executemany(
+                "INSERT INTO HomeworkAttachments (homework_id, position, kind, file_id, file_unique_id) "
+                "VALUES ($1, $2, $3, $4, $5)",
+                [(homework_id, i, a["kind"], a["file_id"], a["file_unique_id"])
+                 for i, a in enumerate(attachments)]
+            )
+            if BROADCAST_ON_UPDATE:
+                broadcast_id = await conn.fetchval(
+                    "INSERT INTO Broadcasts (text, variants, class_id) VALUES ($1, $2, $3) RETURNING id",
+                    f"🔔 Новое ДЗ по <b>{html.quote(subject)}</b>:\n<b>{html.quote(broadcast_preview(hw_text))}</b> [{date_str}]"
+                    + (" 📎" if attachments else ""),
+                    variants_with_subject(class_id, subject), class_id
+                )
+            await notify_homework_changed(conn)
+    await schedule_homework_refresh()
+    if broadcast_id is not None:
+        start_broadcast(broadcast_id)
 
-    await message.answer(f"✅ ДЗ по <b>{subject}</b> обновлено:\n<b>{hw_text}</b> [{date_str}]",
+    files_note = f"\n📎 Вложений: {len(attachments)}" if attachments else ""
+    await message.answer(f"✅ ДЗ по <b>{subject}</b> обновлено:\n<b>{hw_text}</b> [{date_str}]{files_note}",
                          parse_mode="HTML", reply_markup=get_main_menu(message.from_user.id))
     await state.clear()
 
+# -------------------------
+# Массовая загрузка ДЗ
+# -------------------------
+# /bulk_dz — сразу много предметов: строки "предмет: ДЗ" в сообщении или в .txt/.csv.
+# Всё проверяется заранее и пишется одной транзакцией; при любой ошибке не пишется ничего.
+BULK_MAX_FILE_SIZE = 64 * 1024
+TELEGRAM_TEXT_LIMIT = 4000   # лимит Telegram — 4096 символов, оставляем запас на хвост
+BULK_HELP = ("📋 Пришли строки вида <b>предмет: ДЗ</b> — по одной на предмет —\n"
+             "сообщением или файлом .txt/.csv. «Отмена» — выйти.")
+
+def parse_bulk_homework(text: str, class_id: int, is_csv: bool = False) -> tuple:
+    # -> ([(предмет, ДЗ), ...], [ошибки]); пустые строки пропускаем
+    allowed = timetable.class_subjects.get(class_id, frozenset())
+    if is_csv:
+        # Excel с русской локалью сохраняет CSV через ";"; лишние столбцы — продолжение ДЗ
+        delimiter = ";" if ";" in text.split("\n", 1)[0] else ","
+        rows = [row[:1] + [delimiter.join(row[1:])] if len(row) > 1 else row
+                for row in csv.reader(io.StringIO(text), delimiter=delimiter)]
+    else:
+        rows = [line.split(":", 1) for line in text.splitlines()]
+    entries, errors, seen = [], [], set()
+    for line_no, row in enumerate(rows, start=1):
+        if not any(cell.strip() for cell in row):
+            continue
+        if len(row) < 2 or not row[1].strip():
+            errors.append(f"{line_no}: нет текста ДЗ")
+            continue
+        subject, body = row[0].strip(), row[1].strip()
+        if subject not in allowed:
+            errors.append(f"{line_no}: нет предмета «{subject[:40]}»")
+        elif subject in seen:
+            errors.append(f"{line_no}: «{subject}» уже был выше")
+        else:
+            seen.add(subject)
+            entries.append((subject, body))
+    return entries, errors
+
+@dp.message(Command("bulk_dz"))
+async def bulk_dz_start(message: Message, state: FSMContext, command: CommandObject):
+    if message.from_user.id not in ADMINS:
+        await message.answer("⛔ У тебя нет прав добавлять дз.")
+        return
+    class_id, _ = await get_user_profile(message.from_user.id)
+    if command.args:
+        # Строки можно прислать прямо после команды
+        await bulk_dz_apply(message, state, command.args, class_id)
+        return
+    await state.set_state(DzStates.bulk_import)
+    await state.update_data(class_id=class_id)
+    await message.answer(BULK_HELP, parse_mode="HTML",
+                         reply_markup=ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text="Отмена")]],
+                                                          resize_keyboard=True))
+
+@dp.message(DzStates.bulk_import)
+async def bulk_dz_receive(message: Message, state: FSMContext):
+    if (message.text or "").strip() == "Отмена":
+        await state.clear()
+        await message.answer("❌ Загрузка ДЗ отменена.", reply_markup=get_main_menu(message.from_user.id))
+        return
+    data = await state.get_data()
+    class_id = data.get("class_id") or timetable.default_class_id
+    if message.document:
+        name = (message.document.file_name or "").lower()
+        if not name.endswith((".txt", ".csv")):
+            await message.answer("⚠ Нужен файл .txt или .csv.")
+            return
+        if (message.document.file_size or 0) > BULK_MAX_FILE_SIZE:
+            await message.answer(f"⚠ Файл больше {BULK_MAX_FILE_SIZE // 1024} КБ.")
+            return
+        raw = (await bot.download(message.document)).getvalue()
+        try:
+            text = raw.decode("utf-8-sig")
+        except UnicodeDecodeError:
+            try:
+                text = raw.decode("cp1251")  # Excel под Windows сохраняет CSV так
+            except UnicodeDecodeError:
+                await message.answer("⚠ Не удалось прочитать файл: сохрани его в UTF-8.")
+                return
+        await bulk_dz_apply(message, state, text, class_id, is_csv=name.endswith(".csv"))
+    elif message.text:
+        await bulk_dz_apply(message, state, message.text, class_id)
+    else:
+        await message.answer(BULK_HELP, parse_mode="HTML")
+
+async def bulk_dz_apply(message: Message, state: FSMContext, text: str, class_id: int, is_csv: bool = False):
+    entries, errors = parse_bulk_homework(text, class_id, is_csv)
+    if errors or not entries:
+        shown = "\n".join(html.quote(e) for e in errors[:20]) or "Нет ни одной строки с ДЗ."
+        more = f"\n… и ещё {len(errors) - 20}" if len(errors) > 20 else ""
+        await message.answer(f"⚠ Ничего не сохранено, исправь и пришли заново:\n{shown}{more}", parse_mode="HTML")
+        return
+    today = datetime.date.today()
+    date_str = format_hw_date(today)
+    if pool is None:
+        raise RuntimeError("Пул базы данных ещё не инициализирован")
+    # Подтверждение может не влезть в одно сообщение — показываем, сколько влезает
+    lines, length = [], 0
+    for subj, body in entries:
+        line = f"\n<b>{html.quote(subj)}</b>: {html.quote(body)}"
+        if length + len(line) > TELEGRAM_TEXT_LIMIT:
+            lines.append(f"\n… и ещё {len(entries) - len(lines)}")
+            break
+        lines.append(line)
+        length += len(line)
+    broadcast_id = None
+    async with db_acquire() as conn:
+        async with conn.transaction():
+            await conn.executemany(
+                "INSERT INTO Homework (class_id, subject_id, body, hw_date) "
+                "SELECT $4, id, $2, $3 FROM Subjects WHERE name = $1",
+                [(subj, body, today, class_id) for subj, body in entries]
+            )
+            if BROADCAST_ON_UPDATE:
+                variants = sorted({v for subj, _ in entries for v in variants_with_subject(class_id, subj)})
+                broadcast_id = await conn.fetchval(
+                    "INSERT INTO Broadcasts (text, variants, class_id) VALUES ($1, $2, $3) RETURNING id",
+                    # В рассылке только предметы: тексты целиком ученик посмотрит в боте
+                    f"🔔 Новое ДЗ [{date_str}] по предметам: "
+                    + ", ".join(f"<b>{html.quote(subj)}</b>" for subj, _ in entries),
+                    variants, class_id
+                )
+            # Одно уведомление и одно обновление снапшота на всю пачку
+            await notify_homework_changed(conn)
+    await schedule_homework_refresh()
+    if broadcast_id is not None:
+        start_broadcast(broadcast_id)
+    await state.clear()
+    await message.answer(f"✅ Обновлено предметов: {len(entries)} [{date_str}]{''.join(lines)}",
+                         parse_mode="HTML", reply_markup=get_main_menu(message.from_user.id))
+
+# -------------------------
+# Выбор класса
+# -------------------------
+@dp.message(Command("class"))
+async def choose_class_start(message: Message, state: FSMContext):
+    names = sorted(timetable.class_ids)
+    if len(names) < 2:
+        await message.answer("Пока в боте только один класс.", reply_markup=get_main_menu(message.from_user.id))
+        return
+    keyboard_rows = [[KeyboardButton(text=name) for name in names[i:i + 3]] for i in range(0, len(names), 3)]
+    keyboard_rows.append([KeyboardButton(text="Отмена")])
+    await state.set_state(ClassStates.choosing_class)
+    await message.answer("🏫 Выбери свой класс:",
+                         reply_markup=ReplyKeyboardMarkup(keyboard=keyboard_rows, resize_keyboard=True))
+
+@dp.message(ClassStates.choosing_class)
+async def choose_class_save(message: Message, state: FSMContext):
+    user_id = message.from_user.id
+    name = (message.text or "").strip()
+    if name == "Отмена":
+        await state.clear()
+        await message.answer("❌ Выбор класса отменён.", reply_markup=get_main_menu(user_id))
+        return
+    class_id = timetable.class_ids.get(name)
+    if class_id is None:
+        await message.answer("⚠ Такого класса нет. Выбери из списка.")
+        return
+    # Варианты у классов свои — при смене класса вариант выбирается заново
+    async with db_acquire() as conn:
+        await conn.execute(
+            """
+            INSERT INTO UserInfo (user_id, user_name, class_id) VALUES ($1, $2, $3)
+            ON CONFLICT (user_id) DO UPDATE SET
+                class_id = EXCLUDED.class_id,
+                user_option = CASE WHEN UserInfo.class_id IS NOT DISTINCT FROM EXCLUDED.class_id
+                                   THEN UserInfo.user_option END
+            """,
+            user_id, message.from_user.first_name, class_id
+        )
+    _profiles.pop(user_id, None)   # вариант мог сброситься — перечитаем при следующем нажатии
+    await state.clear()
+    await message.answer(f"Ты в классе <b>{html.quote(name)}</b> ✅\n"
+                         "Теперь выбери вариант через кнопку \"🔄 Сменить вариант группы\"",
+                         parse_mode="HTML", reply_markup=get_main_menu(user_id))
+
+@dp.message(Command("reload_timetable"))
+async def reload_timetable_handler(message: Message):
+    if message.from_user.id not in ADMINS:
+        await message.answer("⛔ Недостаточно прав.")
+        return
+    await load_timetable()
+    async with db_acquire() as conn:
+        await conn.execute("SELECT pg_notify($1, $2)", TIMETABLE_NOTIFY_CHANNEL, INSTANCE_ID)
+    await message.answer(f"✅ Расписание перечитано: классов {len(timetable.class_names)}, "
+                         f"версия {timetable.version}", reply_markup=get_main_menu(message.from_user.id))
+
+# -------------------------
+# Повторы апдейтов и флуд
+# -------------------------
+# Telegram повторяет доставку, если вебхук долго отвечает, — один update_id
+# обрабатываем один раз. Частые нажатия одного пользователя ограничиваем
+# токен-бакетом; повтор того же запроса отдаём из прошлого ответа без БД.
+DEDUP_TTL = float(getenv("DEDUP_TTL", "600"))
+DEDUP_MAX = 10000
+THROTTLE_RATE = float(getenv("THROTTLE_RATE", "1"))            # запросов/с на пользователя
+THROTTLE_BURST = float(getenv("THROTTLE_BURST", "5"))
+THROTTLE_REPEAT_WINDOW = float(getenv("THROTTLE_REPEAT_WINDOW", "30"))
+THROTTLE_MAX_USERS = 10000
+CACHEABLE_BUTTONS = frozenset({"📅 Дз на сегодня", "📅 Дз на завтра", "📖 Полное расписание"})
+
+UPDATES_DUPLICATE = Counter("bot_updates_duplicate_total", "Redelivered updates dropped by update_id")
+MESSAGES_THROTTLED = Counter("bot_messages_throttled_total", "Messages throttled per user", ("action",))
+
+_seen_updates = OrderedDict()   # update_id -> когда пришёл
+_user_buckets = OrderedDict()   # user_id -> TokenBucket
+_last_replies = OrderedDict()   # user_id -> (запрос, версия ответов, ответ, когда, клавиатура, вложения)
+
+def _lru_put(cache: OrderedDict, key, value, limit: int):
+    cache.pop(key, None)
+    cache[key] = value
+    while len(cache) > limit:
+        cache.popitem(last=False)
+
+def remember_reply(user_id: int, request: str, reply: str, markup=None, media: tuple = ()):
+    _lru_put(_last_replies, user_id,
+             (request, (hw_version, timetable.version), reply, time.monotonic(), markup, media),
+             THROTTLE_MAX_USERS)
+
+@dp.update.outer_middleware()
+async def dedup_middleware(handler, event: Update, data: dict):
+    now = time.monotonic()
+    # Выкидываем устаревшие и лишние — размер кэша ограничен
+    while _seen_updates:
+        oldest, seen_at = next(iter(_seen_updates.items()))
+        if now - seen_at < DEDUP_TTL and len(_seen_updates) < DEDUP_MAX:
+            break
+        del _seen_updates[oldest]
+    if event.update_id in _seen_updates:
+        UPDATES_DUPLICATE.inc()
+        logger.info(f"Duplicate update {event.update_id} dropped")
+        return None
+    _seen_updates[event.update_id] = now
+    return await handler(event, data)
+
+@dp.message.outer_middleware()
+async def throttle_middleware(handler, event: Message, data: dict):
+    if event.from_user is None:
+        return await handler(event, data)
+    user_id = event.from_user.id
+    bucket = _user_buckets.get(user_id) or TokenBucket(THROTTLE_RATE, THROTTLE_BURST)
+    _lru_put(_user_buckets, user_id, bucket, THROTTLE_MAX_USERS)
+    # Альбом приходит пачкой апдейтов — его части не ограничиваем
+    if event.media_group_id is None and not bucket.try_take():
+        MESSAGES_THROTTLED.inc("dropped")
+        return None
+
+    if event.text not in CACHEABLE_BUTTONS or data.get("raw_state") is not None:
+        # Любое другое действие (смена варианта, ДЗ админа) может изменить ответ
+        _last_replies.pop(user_id, None)
+        return await handler(event, data)
+    last = _last_replies.get(user_id)
+    if (last is not None and last[0] == event.text and last[1] == (hw_version, timetable.version)
+            and time.monotonic() - last[3] < THROTTLE_REPEAT_WINDOW):
+        MESSAGES_THROTTLED.inc("cached")
+        sent = await event.answer(last[2], parse_mode="HTML", reply_markup=last[4])
+        remember_view(sent, last[2], last[4])
+        # Ответ повторяем целиком: в тексте стоит 📎, значит, и альбомы должны прийти
+        await send_media(event, last[5])
+        return None
+    return await handler(event, data)
+
+@dp.callback_query.outer_middleware()
+async def callback_throttle_middleware(handler, event: CallbackQuery, data: dict):
+    bucket = _user_buckets.get(event.from_user.id) or TokenBucket(THROTTLE_RATE, THROTTLE_BURST)
+    _lru_put(_user_buckets, event.from_user.id, bucket, THROTTLE_MAX_USERS)
+    if not bucket.try_take():
+        MESSAGES_THROTTLED.inc("dropped")
+        await event.answer()  # иначе у кнопки крутятся часики
+        return None
+    return await handler(event, data)
+
+# -------------------------
+# Время обработчиков
+# -------------------------
+# Кнопки меню — метка для гистограммы; произвольный текст пишем как "other"
+MENU_BUTTONS = frozenset({
+    "📅 Дз на сегодня", "📅 Дз на завтра", "📖 Полное расписание",
+    "🔄 Сменить вариант группы", "1", "2", "Добавить ДЗ",
+})
+
+@dp.message.middleware()
+async def handler_metrics_middleware(handler, event: Message, data: dict):
+    name = data["handler"].callback.__name__
+    button = event.text if event.text in MENU_BUTTONS else "other"
+    started = time.perf_counter()
+    try:
+        return await handler(event, data)
+    finally:
+        elapsed = time.perf_counter() - started
+        HANDLER_SECONDS.observe(elapsed, name, button)
+        if _profiler is not None:
+            _profiler.record_handler(name, elapsed)
+
+@dp.callback_query.middleware()
+async def callback_metrics_middleware(handler, event: CallbackQuery, data: dict):
+    name = data["handler"].callback.__name__
+    button = ":".join((event.data or "other").split(":", 2)[:2])   # "nav:day" без даты
+    started = time.perf_counter()
+    try:
+        return await handler(event, data)
+    finally:
+        elapsed = time.perf_counter() - started
+        HANDLER_SECONDS.observe(elapsed, name, button)
+        if _profiler is not None:
+            _profiler.record_handler(name, elapsed)
+
+# -------------------------
+# Инлайн-навигация
+# -------------------------
+# Под ответом — вкладки дней недели, вся неделя и смена варианта. Нажатие правит
+# то же сообщение (editMessageText) вместо нового; если текст и кнопки не
+# изменились, запрос к Bot API не делаем вовсе. callback_data: "nav:<действие>:...",
+# дата — ISO, так что кнопка в старом сообщении открывает свою неделю.
+DAY_TABS = ["Пн", "Вт", "Ср", "Чт", "Пт"]
+NAV_HASH_MAX = 10000
+CHOOSE_VARIANT_TEXT = "<b>Выбери свой вариант группы:</b>"
+
+NAV_EDITS = Counter("bot_nav_edits_total", "Inline navigation presses by result", ("result",))
+
+_view_hashes = OrderedDict()   # (chat_id, message_id) -> хэш текста и кнопок
+
+def _week_start(day: datetime.date) -> datetime.date:
+    return day - datetime.timedelta(days=day.weekday())
+
+def _nav_default_day(monday: datetime.date) -> datetime.date:
+    # Ближайший учебный день, если он на этой неделе, иначе понедельник
+    day = next_school_day(datetime.date.today())
+    return day if _week_start(day) == monday else monday
+
+def variant_markup(profile: tuple, monday: datetime.date) -> InlineKeyboardMarkup:
+    class_id, user_option = profile
+    variants = timetable.class_variants.get(class_id, ())
+    rows = [[InlineKeyboardButton(text=f"Вариант {v}", callback_data=f"nav:set:{v}:{monday.isoformat()}")
+             for v in variants]]
+    if user_option in variants:
+        rows.append([InlineKeyboardButton(text="⬅ Назад",
+                                          callback_data=f"nav:day:{_nav_default_day(monday).isoformat()}")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+def nav_markup(profile: tuple, day: datetime.date, full: bool = False) -> InlineKeyboardMarkup:
+    class_id, user_option = profile
+    monday = _week_start(day)
+    if user_option not in timetable.class_variants.get(class_id, ()):
+        return variant_markup(profile, monday)
+    tabs = [
+        InlineKeyboardButton(text=f"·{name}·" if not full and d == day.weekday() else name,
+                             callback_data=f"nav:day:{(monday + datetime.timedelta(days=d)).isoformat()}")
+        for d, name in enumerate(DAY_TABS)
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=[tabs, [
+        InlineKeyboardButton(text="·Неделя·" if full else "📖 Неделя", callback_data=f"nav:full:{monday.isoformat()}"),
+        InlineKeyboardButton(text=f"🔄 Вариант {user_option}", callback_data=f"nav:var:{monday.isoformat()}"),
+    ]])
+
+def _view_digest(text: str, markup) -> int:
+    buttons = "".join(f"|{b.text}\t{b.callback_data}" for row in markup.inline_keyboard for b in row) if markup else ""
+    return zlib.crc32((text + buttons).encode())
+
+def remember_view(message: Message, text: str, markup):
+    if markup is not None:
+        _lru_put(_view_hashes, (message.chat.id, message.message_id), _view_digest(text, markup), NAV_HASH_MAX)
+
+async def show_view(callback: CallbackQuery, text: str, markup: InlineKeyboardMarkup):
+    message = callback.message
+    if not isinstance(message, Message):
+        # Сообщение старше 48 часов редактировать нельзя — присылаем новое
+        sent = await bot.send_message(callback.from_user.id, text, parse_mode="HTML", reply_markup=markup)
+        remember_view(sent, text, markup)
+        NAV_EDITS.inc("sent")
+        return
+    key = (message.chat.id, message.message_id)
+    digest = _view_digest(text, markup)
+    if _view_hashes.get(key) == digest:
+        NAV_EDITS.inc("skipped")
+        return
+    try:
+        await message.edit_text(text, parse_mode="HTML", reply_markup=markup)
+        NAV_EDITS.inc("edited")
+    except TelegramBadRequest as e:
+        # После рестарта хэшей нет — Telegram сам скажет, что менять нечего
+        if "message is not modified" not in str(e):
+            raise
+        NAV_EDITS.inc("skipped")
+    _lru_put(_view_hashes, key, digest, NAV_HASH_MAX)
+
+@dp.callback_query(lambda c: (c.data or "").startswith("nav:"))
+async def nav_callback(callback: CallbackQuery):
+    # Отвечаем сразу: клиент перестаёт крутить часики, дальше — только правка сообщения
+    await callback.answer()
+    parts = callback.data.split(":")
+    try:
+        action = parts[1]
+        day = datetime.date.fromisoformat(parts[-1])
+        variant = int(parts[2]) if action == "set" else None
+    except (IndexError, ValueError):
+        return
+    monday = _week_start(day)
+    profile = await touch_user_profile(callback.from_user)
+    class_id, user_option = profile
+
+    if action == "set":
+        if variant in timetable.class_variants.get(class_id, ()):
+            if variant != user_option:
+                async with db_acquire() as conn:
+                    await conn.execute("UPDATE UserInfo SET user_option=$2 WHERE user_id=$1",
+                                       callback.from_user.id, variant)
+                remember_profile(callback.from_user.id, (class_id, variant))
+                # Ответ, запомненный для прежнего варианта, больше не годится
+                _last_replies.pop(callback.from_user.id, None)
+            profile = (class_id, variant)
+            action, day = "day", _nav_default_day(monday)
+        else:
+            action = "var"
+
+    if action == "day":
+        text, _ = await get_homework_for_day(profile, day)
+        markup = nav_markup(profile, day)
+    elif action == "full":
+        text = await get_full_schedule(profile, monday)
+        markup = nav_markup(profile, monday, full=True)
+    elif action == "var":
+        text = CHOOSE_VARIANT_TEXT
+        markup = variant_markup(profile, monday)
+    else:
+        return
+    await show_view(callback, text, markup)
+
 # -------------------------
 # Основные кнопки
 # -------------------------
@@ -406,36 +2356,45 @@ async def handle_buttons(message: Message):
     user_id = message.from_user.id
     text = message.text
 
-    if pool is not None:
-        async with pool.acquire() as conn:
-            await conn.execute(
-                """
-                INSERT INTO UserInfo (user_id, user_name)
-                VALUES ($1, $2)
-                ON CONFLICT (user_id) DO UPDATE
-                SET user_name = EXCLUDED.user_name
-                """,
-                message.from_user.id,
-                message.from_user.first_name
-            )
+    # Имя и профиль — одним запросом; ДЗ и расписание дальше берутся из памяти
+    profile = await touch_user_profile(message.from_user)
+    class_id = profile[0]
 
     if text == "📅 Дз на сегодня":
-        current_day = datetime.datetime.today().weekday()
-        if current_day > 4: current_day = 0
-        dz = await get_homework_for_day(user_id, current_day)
-        await message.answer(dz, parse_mode="HTML", reply_markup=get_main_menu(user_id))
+        # В выходные показываем понедельник
+        day = next_school_day(datetime.date.today())
+        dz, media = await get_homework_for_day(profile, day)
+        markup = nav_markup(profile, day)
+        remember_reply(user_id, text, dz, markup, media)
+        remember_view(await message.answer(dz, parse_mode="HTML", reply_markup=markup), dz, markup)
+        await send_media(message, media)
 
     elif text == "📅 Дз на завтра":
-        current_day = datetime.datetime.today().weekday()
-        next_day = 0 if current_day >= 4 else current_day + 1
-        dz = await get_homework_for_day(user_id, next_day)
-        await message.answer(dz, parse_mode="HTML", reply_markup=get_main_menu(user_id))
+        day = next_school_day(datetime.date.today() + datetime.timedelta(days=1))
+        dz, media = await get_homework_for_day(profile, day)
+        markup = nav_markup(profile, day)
+        remember_reply(user_id, text, dz, markup, media)
+        remember_view(await message.answer(dz, parse_mode="HTML", reply_markup=markup), dz, markup)
+        await send_media(message, media)
 
     elif text == "📖 Полное расписание":
-        full_schedule = await get_full_schedule(user_id)
-        await message.answer(full_schedule, parse_mode="HTML", reply_markup=get_main_menu(user_id))
+        week = next_school_day(datetime.date.today())
+        full_schedule = await get_full_schedule(profile, week)
+        markup = nav_markup(profile, week, full=True)
+        remember_reply(user_id, text, full_schedule, markup)
+        remember_view(await message.answer(full_schedule, parse_mode="HTML", reply_markup=markup),
+                      full_schedule, markup)
 
     elif text == "🔄 Сменить вариант группы":
+        variants = timetable.class_variants.get(class_id, ())
+        keyboard = ReplyKeyboardMarkup(
+            keyboard=[[KeyboardButton(text=str(variant)) for variant in variants]],
+            resize_keyboard=True
+        )
+        if class_id != timetable.default_class_id:
+            await message.answer("<b>Выбери свой вариант группы:</b>", parse_mode="HTML", reply_markup=keyboard)
+            return
+
         await message.answer("<b>Выбери свой вариант группы:</b>", parse_mode="HTML")
 
         variant1 = ["Зизевский Пётр", "Каримов Артур", "Старостин Матвей", "Чернов Степан", "И т.д."]
@@ -457,20 +2416,17 @@ async def handle_buttons(message: Message):
         # Оборачиваем всё в <pre>
         text_variants = "<pre>" + "\n".join(lines) + "</pre>"
 
-        keyboard = ReplyKeyboardMarkup(
-            keyboard=[[KeyboardButton(text="1"), KeyboardButton(text="2")]],
-            resize_keyboard=True
-        )
-
         await message.answer(text_variants, parse_mode="HTML", reply_markup=keyboard)
 
-    elif text in ["1","2"]:
-        if pool is None:
-            raise RuntimeError("Пул базы данных ещё не инициализирован")
-        async with pool.acquire() as conn:
+    elif text and text.isdecimal() and len(text) <= 2:
+        if int(text) not in timetable.class_variants.get(class_id, ()):
+            await message.answer("⚠ Такого варианта нет. Выбери из списка.")
+            return
+        async with db_acquire() as conn:
             await conn.execute(
-                "UPDATE UserInfo SET user_option=$1 WHERE user_id=$2", int(text), user_id
+                "UPDATE UserInfo SET user_option=$2 WHERE user_id=$1", user_id, int(text)
             )
+        remember_profile(user_id, (class_id, int(text)))
         await message.answer(f"Ты выбрал вариант {text} ✅", reply_markup=get_main_menu(user_id))
 
 
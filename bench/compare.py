@@ -0,0 +1,37 @@
+# Сравнение двух прогонов bench/load.py: python bench/compare.py old.json new.json
+# Положительная разница в задержке — стало медленнее.
+import sys
+import json
+
+
+def load(path: str) -> dict:
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def delta(old: float, new: float) -> str:
+    if not old:
+        return "     n/a"
+    return f"{(new - old) / old * 100:+7.1f}%"
+
+
+def main():
+    if len(sys.argv) != 3:
+        sys.exit("usage: python bench/compare.py old.json new.json")
+    old, new = load(sys.argv[1]), load(sys.argv[2])
+    print(f"{old['commit']} -> {new['commit']}")
+    print(f"throughput: {old['throughput_rps']:.1f} -> {new['throughput_rps']:.1f} updates/s "
+          f"{delta(old['throughput_rps'], new['throughput_rps'])}")
+    print(f"{'path':<16}{'p50':>10}{'p95':>10}{'p99':>10}{'db rt':>14}")
+    for path in sorted(set(old["paths"]) | set(new["paths"])):
+        a, b = old["paths"].get(path), new["paths"].get(path)
+        if a is None or b is None:
+            print(f"{path:<16} only in {'new' if a is None else 'old'} run")
+            continue
+        print(f"{path:<16}{delta(a['p50_ms'], b['p50_ms']):>10}{delta(a['p95_ms'], b['p95_ms']):>10}"
+              f"{delta(a['p99_ms'], b['p99_ms']):>10}"
+              f"{a['db_roundtrips_avg']:>7.2f}->{b['db_roundtrips_avg']:<5.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+# Замер разбора вебхука: сколько апдейтов в секунду успевает одно ядро.
+#   python bench/decode.py [итераций]
+# Сравниваются старый путь (request.json + model_validate + пересборка в feed_update)
+# и новый быстрый путь.
+import os
+import sys
+import json
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+os.environ.setdefault("DATABASE_URL", "postgresql://localhost/bench")
+os.environ.setdefault("BASE_URL", "http://localhost")
+
+import Bot as bot_module  # noqa: E402
+from aiogram import Bot  # noqa: E402
+from aiogram.types import Update  # noqa: E402
+
+BUTTON_UPDATE = {
+    "update_id": 100500,
+    "message": {
+        "message_id": 42,
+        "from": {"id": 1920672301, "is_bot": False, "first_name": "Пётр", "language_code": "ru"},
+        "chat": {"id": 1920672301, "type": "private", "first_name": "Пётр"},
+        "date": 1760000000,
+        "text": "📅 Дз на сегодня",
+    },
+}
+BODY = json.dumps(BUTTON_UPDATE).encode()
+
+
+def legacy(bot):
+    raw = json.loads(BODY)
+    update = Update.model_validate(raw)
+    # то, что делал feed_update для апдейта без привязанного бота
+    return Update.model_validate(update.model_dump(), context={"bot": bot})
+
+
+def fast(bot):
+    raw = bot_module._json_loads(BODY)
+    if not bot_module.is_handled_update(raw):
+        return None
+    return bot_module.build_update(raw)
+
+
+def measure(name, fn, bot, iterations):
+    fn(bot)
+    started = time.perf_counter()
+    for _ in range(iterations):
+        fn(bot)
+    elapsed = time.perf_counter() - started
+    print(f"{name:<8} {iterations / elapsed:>10.0f} updates/s")
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    bot = Bot(token=os.environ["BOT_TOKEN"])
+    bot_module.bot = bot
+    bot_module.handled_update_types = frozenset(bot_module.dp.resolve_used_update_types())
+
+    measure("legacy", legacy, bot, iterations)
+    measure("fast", fast, bot, iterations)
+
+
+if __name__ == "__main__":
+    main()
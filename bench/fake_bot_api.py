@@ -0,0 +1,62 @@
+# Локальная заглушка Bot API: принимает вызовы бота, ничего никуда не отправляет
+# и считает, какие методы сколько раз вызывались.
+#   python bench/fake_bot_api.py [порт]
+# Бот направляется сюда через TELEGRAM_API_URL=http://127.0.0.1:<порт>
+import sys
+import time
+from collections import Counter
+
+from aiohttp import web
+
+BOT_USER = {"id": 100000, "is_bot": True, "first_name": "BenchBot", "username": "bench_bot"}
+
+calls = Counter()
+_message_id = 0
+
+
+def _message(fields) -> dict:
+    global _message_id
+    _message_id += 1
+    chat_id = int(fields.get("chat_id", 0))
+    return {
+        "message_id": _message_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": BOT_USER,
+        "text": fields.get("text") or fields.get("caption") or "",
+    }
+
+
+async def handle(request: web.Request) -> web.Response:
+    method = request.match_info["method"]
+    calls[method] += 1
+    fields = await request.post()
+
+    if method in ("sendMessage", "sendPhoto", "sendDocument", "editMessageText"):
+        result = _message(fields)
+    elif method == "sendMediaGroup":
+        result = [_message(fields)]
+    elif method == "getMe":
+        result = BOT_USER
+    elif method == "getWebhookInfo":
+        result = {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+    else:
+        result = True
+    return web.json_response({"ok": True, "result": result})
+
+
+def make_app() -> web.Application:
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", handle)
+    return app
+
+
+async def start(port: int) -> web.AppRunner:
+    runner = web.AppRunner(make_app())
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+if __name__ == "__main__":
+    web.run_app(make_app(), host="127.0.0.1", port=int(sys.argv[1]) if len(sys.argv) > 1 else 8081)
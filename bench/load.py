@@ -0,0 +1,243 @@
+# Нагрузочный прогон вебхука: синтетические апдейты -> FastAPI app -> handle_buttons и остальные обработчики.
+#   DATABASE_URL=postgresql://localhost/bot_bench python bench/load.py --users 200 --concurrency 50 --updates 5000
+# Нужен локальный Postgres (данные бенчмарка пишутся в его таблицы) — используй отдельную базу.
+# Bot API подменяется заглушкой bench/fake_bot_api.py, запросы в Telegram не уходят.
+# Результат печатается таблицей и сохраняется в bench/results/<время>-<коммит>.json;
+# сравнить два прогона: python bench/compare.py old.json new.json
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import datetime
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+
+ADMIN_ID = 1920672301
+FIRST_USER_ID = 10_000_000
+
+# Доля каждого сценария в потоке апдейтов
+SCENARIOS = [
+    ("today", 35),
+    ("tomorrow", 25),
+    ("full_schedule", 15),
+    ("change_variant", 5),
+    ("choose_variant", 5),
+    ("start", 5),
+    ("unknown", 5),
+    ("add_dz", 5),
+]
+
+BUTTON_TEXT = {
+    "today": "📅 Дз на сегодня",
+    "tomorrow": "📅 Дз на завтра",
+    "full_schedule": "📖 Полное расписание",
+    "change_variant": "🔄 Сменить вариант группы",
+    "unknown": "привет",
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--api-port", type=int, default=8081)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--label", default="")
+    return parser.parse_args()
+
+
+def setup_env(api_port: int):
+    if not os.environ.get("DATABASE_URL"):
+        sys.exit("Укажи DATABASE_URL локального Postgres для бенчмарка")
+    os.environ.setdefault("BOT_TOKEN", "123456:bench")
+    os.environ.setdefault("BASE_URL", "http://127.0.0.1")
+    os.environ.setdefault("DB_SSL", "0")
+    # Виртуальные пользователи жмут кнопки чаще живых: без этого мерили бы отброшенные апдейты
+    # и ответы из кэша повторов. Включить обратно — задать переменные явно.
+    os.environ.setdefault("THROTTLE_RATE", "1e9")
+    os.environ.setdefault("THROTTLE_BURST", "1e9")
+    os.environ.setdefault("THROTTLE_REPEAT_WINDOW", "0")
+    os.environ["TELEGRAM_API_URL"] = f"http://127.0.0.1:{api_port}"
+
+
+class UpdateFactory:
+    def __init__(self):
+        self.update_id = 0
+        self.message_id = 0
+
+    def message(self, user_id: int, text: str) -> dict:
+        self.update_id += 1
+        self.message_id += 1
+        message = {
+            "message_id": self.message_id,
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+            "chat": {"id": user_id, "type": "private", "first_name": f"User{user_id}"},
+            "date": int(time.time()),
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+        return {"update_id": self.update_id, "message": message}
+
+
+def scenario_messages(name: str, user_id: int, rnd: random.Random) -> list:
+    # Список (путь, user_id, текст); add_dz — это три сообщения подряд от админа
+    if name == "start":
+        return [("start", user_id, "/start")]
+    if name == "choose_variant":
+        return [("choose_variant", user_id, rnd.choice(["1", "2"]))]
+    if name == "add_dz":
+        return [
+            ("add_dz_start", ADMIN_ID, "Добавить ДЗ"),
+            ("add_dz_subject", ADMIN_ID, rnd.choice(["Алгебра", "Физика", "История"])),
+            ("add_dz_save", ADMIN_ID, f"Бенчмарк {rnd.randint(1, 10**6)}"),
+        ]
+    return [(name, user_id, BUTTON_TEXT[name])]
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+async def run(args):
+    import httpx
+    import fake_bot_api
+    import Bot as bot_module
+
+    runner = await fake_bot_api.start(args.api_port)
+    app = bot_module.app
+    await app.router.startup()
+    rnd = random.Random(args.seed)
+    factory = UpdateFactory()
+    samples = {}    # путь -> [(секунды, обращений к БД)]
+    errors = 0
+    admin_lock = asyncio.Lock()  # сценарий админа — цепочка состояний, не перемешиваем
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def send(path: str, user_id: int, text: str):
+            nonlocal errors
+            counter = [0]
+            token = bot_module.db_roundtrips.set(counter)
+            started = time.perf_counter()
+            try:
+                response = await client.post(bot_module.WEBHOOK_PATH, json=factory.message(user_id, text))
+                if response.status_code != 200 or not response.json().get("ok"):
+                    errors += 1
+            finally:
+                bot_module.db_roundtrips.reset(token)
+            samples.setdefault(path, []).append((time.perf_counter() - started, counter[0]))
+
+        # Прогрев: у каждого пользователя есть строка и выбран вариант
+        users = [FIRST_USER_ID + i for i in range(args.users)]
+        for user_id in users:
+            await send("warmup", user_id, "/start")
+            await send("warmup", user_id, rnd.choice(["1", "2"]))
+        samples.pop("warmup", None)
+
+        names = [name for name, _ in SCENARIOS]
+        weights = [weight for _, weight in SCENARIOS]
+        remaining = args.updates
+
+        async def virtual_user():
+            nonlocal remaining
+            while remaining > 0:
+                remaining -= 1
+                name = rnd.choices(names, weights)[0]
+                messages = scenario_messages(name, rnd.choice(users), rnd)
+                if name == "add_dz":
+                    async with admin_lock:
+                        for message in messages:
+                            await send(*message)
+                else:
+                    for message in messages:
+                        await send(*message)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(virtual_user() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+
+    await app.router.shutdown()
+    await runner.cleanup()
+    # Вебхук отвечает ok и на отброшенные апдейты — считаем их отдельно
+    throttled = {action: int(bot_module.MESSAGES_THROTTLED.value(action)) for action in ("dropped", "cached")}
+    throttled["duplicate"] = int(bot_module.UPDATES_DUPLICATE.value())
+    return samples, elapsed, errors, throttled, dict(fake_bot_api.calls)
+
+
+def summarize(samples: dict, elapsed: float) -> dict:
+    paths = {}
+    for path, values in sorted(samples.items()):
+        latencies = [latency * 1000 for latency, _ in values]
+        roundtrips = [count for _, count in values]
+        paths[path] = {
+            "count": len(values),
+            "rps": len(values) / elapsed,
+            "p50_ms": percentile(latencies, 50),
+            "p95_ms": percentile(latencies, 95),
+            "p99_ms": percentile(latencies, 99),
+            "db_roundtrips_avg": sum(roundtrips) / len(roundtrips),
+            "db_roundtrips_max": max(roundtrips),
+        }
+    return paths
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_table(paths: dict):
+    print(f"{'path':<16}{'count':>8}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'db rt':>8}")
+    for path, row in paths.items():
+        print(f"{path:<16}{row['count']:>8}{row['rps']:>10.1f}{row['p50_ms']:>10.2f}"
+              f"{row['p95_ms']:>10.2f}{row['p99_ms']:>10.2f}{row['db_roundtrips_avg']:>8.2f}")
+
+
+def main():
+    args = parse_args()
+    setup_env(args.api_port)
+    sys.path.insert(0, BENCH_DIR)
+    samples, elapsed, errors, throttled, api_calls = asyncio.run(run(args))
+    paths = summarize(samples, elapsed)
+    total = sum(row["count"] for row in paths.values())
+
+    print_table(paths)
+    print(f"total: {total} updates in {elapsed:.2f}s = {total / elapsed:.1f} updates/s, errors: {errors}")
+    print(f"throttled: {throttled}")
+    print(f"Bot API calls: {api_calls}")
+
+    commit = git_commit()
+    result = {
+        "commit": commit,
+        "label": args.label,
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "args": vars(args),
+        "elapsed_s": elapsed,
+        "throughput_rps": total / elapsed,
+        "errors": errors,
+        "throttled": throttled,
+        "api_calls": api_calls,
+        "paths": paths,
+    }
+    results_dir = os.path.join(BENCH_DIR, "results")
+    os.makedirs(results_dir, exist_ok=True)
+    name = f"{datetime.datetime.now():%Y%m%d-%H%M%S}-{commit}.json"
+    with open(os.path.join(results_dir, name), "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"saved: bench/results/{name}")
+
+
+if __name__ == "__main__":
+    main()